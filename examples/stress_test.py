@@ -0,0 +1,379 @@
+"""
+FrostedGlass stress test
+========================
+
+Renders grids of 1 to 200 FrostedGlass instances over different kinds of
+backgrounds, for a fixed number of frames, and reports for each scenario:
+
+* the number of frames until all the instances are ready;
+* frame time percentiles (p50, p95, p99 and max, in ms);
+* the number of property bindings in the window's widget tree;
+* an estimate of the GPU memory used by the Fbos and textures of FrostedGlass.
+
+Backgrounds:
+
+* static → an image that doesn't change;
+* scrolling → a ScrollView scrolled every frame (as in "MOVING BACKGROUND");
+* video → a Video whose texture is updated in place every frame;
+* animated → widgets moved every frame.
+
+The run fails (exit status 1) when a scenario exceeds one of the thresholds
+(``--max-p95``, ``--max-p99``, ``--max-gpu-mb``, ``--max-bindings``), or
+regresses by more than ``--tolerance`` compared to a ``--baseline`` saved
+with ``--save-baseline``, so it can be used to gate releases.
+
+Without a display, run it with a virtual one, e.g.
+``xvfb-run python stress_test.py``.
+
+Examples::
+
+    python stress_test.py --counts 1,10,50 --frames 60
+    python stress_test.py --save-baseline baseline.json
+    python stress_test.py --baseline baseline.json --tolerance 0.25
+"""
+
+import os
+
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+
+from kivy.config import Config  # noqa: E402
+
+# Frames must not be throttled to measure their duration.
+Config.set("graphics", "maxfps", "0")
+Config.set("graphics", "width", "800")
+Config.set("graphics", "height", "600")
+
+import argparse  # noqa: E402
+import gc  # noqa: E402
+import json  # noqa: E402
+import math  # noqa: E402
+import sys  # noqa: E402
+from time import perf_counter as now  # noqa: E402
+
+from kivy.base import EventLoop  # noqa: E402
+from kivy.core.window import Window  # noqa: E402
+from kivy.graphics import Color, Ellipse, Rectangle  # noqa: E402
+from kivy.graphics.opengl import glFinish  # noqa: E402
+from kivy.graphics.texture import Texture  # noqa: E402
+from kivy.uix.boxlayout import BoxLayout  # noqa: E402
+from kivy.uix.floatlayout import FloatLayout  # noqa: E402
+from kivy.uix.image import Image  # noqa: E402
+from kivy.uix.scrollview import ScrollView  # noqa: E402
+from kivy.uix.video import Video  # noqa: E402
+from kivy.uix.widget import Widget  # noqa: E402
+
+from kivy_garden.frostedglass import FrostedGlass  # noqa: E402
+from kivy_garden.frostedglass.initialization import initializer  # noqa: E402
+from kivy_garden.frostedglass.memory import gpu_memory  # noqa: E402
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BACKGROUND_IMAGE = os.path.join(HERE, "bg_example.png")
+LOGO_IMAGE = os.path.join(HERE, "kivy_logo.png")
+
+BACKGROUNDS = ("static", "scrolling", "video", "animated")
+COUNTS = (1, 10, 50, 100, 200)
+
+
+# Backgrounds. Each one returns the background widget and a function called
+# before every frame, to animate it.
+
+def static_background():
+    return Image(source=BACKGROUND_IMAGE, fit_mode="fill"), None
+
+
+def scrolling_background():
+    scroll_view = ScrollView()
+    content = BoxLayout(orientation="vertical", size_hint_y=3)
+    for _ in range(6):
+        content.add_widget(Image(source=LOGO_IMAGE, fit_mode="contain"))
+    scroll_view.add_widget(content)
+
+    def step(frame):
+        scroll_view.scroll_y = 0.5 + 0.5 * math.sin(frame / 20)
+
+    return scroll_view, step
+
+
+def video_background():
+    # A Video without source, whose texture is updated in place and position
+    # advanced every frame, as a playing video does.
+    video = Video(fit_mode="fill")
+    size = (160, 120)
+    texture = Texture.create(size=size, colorfmt="rgb")
+    video.texture = texture
+    row = bytes(range(0, 240, 2)) * 4
+
+    def step(frame):
+        shift = (frame * 9) % len(row)
+        line = (row[shift:] + row[:shift])[:size[0] * 3]
+        texture.blit_buffer(
+            line * size[1], colorfmt="rgb", bufferfmt="ubyte"
+        )
+        video.canvas.ask_update()
+        video.position = frame / 60
+
+    return video, step
+
+
+def animated_background():
+    background = FloatLayout()
+    with background.canvas.before:
+        Color(0.05, 0.05, 0.2)
+        rect = Rectangle()
+    background.bind(size=lambda w, size: setattr(rect, "size", size))
+    blobs = []
+    for i in range(8):
+        blob = Widget(size_hint=(None, None), size=(160, 160))
+        with blob.canvas:
+            Color(hsv=(i / 8, 0.8, 0.9))
+            blob.ellipse = Ellipse(size=blob.size)
+        blob.bind(pos=lambda w, pos: setattr(w.ellipse, "pos", pos))
+        background.add_widget(blob)
+        blobs.append(blob)
+
+    def step(frame):
+        for i, blob in enumerate(blobs):
+            angle = frame / 15 + i * math.pi / 4
+            blob.pos = (
+                Window.width / 2 + math.cos(angle) * Window.width / 3 - 80,
+                Window.height / 2 + math.sin(angle) * Window.height / 3 - 80,
+            )
+
+    return background, step
+
+
+BACKGROUND_FACTORIES = {
+    "static": static_background,
+    "scrolling": scrolling_background,
+    "video": video_background,
+    "animated": animated_background,
+}
+
+
+def build_scenario(background_name, count, backend):
+    root = FloatLayout()
+    background, step = BACKGROUND_FACTORIES[background_name]()
+    root.add_widget(background)
+
+    cols = math.ceil(math.sqrt(count))
+    rows = math.ceil(count / cols)
+    cell_width = Window.width / cols
+    cell_height = Window.height / rows
+    glasses = []
+    for i in range(count):
+        fg = FrostedGlass(size_hint=(None, None))
+        fg.size = (cell_width * 0.8, cell_height * 0.8)
+        fg.pos = (
+            (i % cols + 0.1) * cell_width,
+            (i // cols + 0.1) * cell_height,
+        )
+        fg.blur_backend = backend
+        fg.border_radius = [min(fg.size) / 4] * 4
+        fg.background = background
+        root.add_widget(fg)
+        glasses.append(fg)
+    return root, glasses, step
+
+
+def iter_widgets(widget):
+    yield widget
+    for child in widget.children:
+        yield from iter_widgets(child)
+
+
+def count_bindings():
+    """Number of property observers in the window's widget tree."""
+    total = 0
+    for widget in iter_widgets(Window):
+        for name in widget.properties():
+            total += len(widget.get_property_observers(name))
+    return total
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = (len(values) - 1) * percent / 100
+    lower = math.floor(index)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (index - lower)
+
+
+def run_scenario(background_name, count, frames, warmup, backend):
+    root, glasses, step = build_scenario(background_name, count, backend)
+    bindings_before = count_bindings()
+    Window.add_widget(root)
+    frame_times = []
+    try:
+        # The initialization of the instances is spread across frames.
+        ready_frames = 0
+        EventLoop.idle()
+        while initializer.pending:
+            EventLoop.idle()
+            ready_frames += 1
+        for frame in range(warmup + frames):
+            start = now()
+            if step is not None:
+                step(frame)
+            EventLoop.idle()
+            # Include the time spent by the GPU.
+            glFinish()
+            if frame >= warmup:
+                frame_times.append((now() - start) * 1000)
+        bindings = count_bindings() - bindings_before
+        # Includes the resources shared by the instances.
+        gpu_memory_used = gpu_memory.allocated
+    finally:
+        Window.remove_widget(root)
+        del root, glasses
+        gc.collect()
+        EventLoop.idle()
+
+    return {
+        "background": background_name,
+        "count": count,
+        "frames": frames,
+        "ready_frames": ready_frames,
+        "p50": percentile(frame_times, 50),
+        "p95": percentile(frame_times, 95),
+        "p99": percentile(frame_times, 99),
+        "max": max(frame_times),
+        "bindings": bindings,
+        "bindings_per_instance": bindings / count,
+        "gpu_memory_mb": gpu_memory_used / 2 ** 20,
+    }
+
+
+def check_thresholds(result, args):
+    failures = []
+    limits = (
+        ("p95", args.max_p95),
+        ("p99", args.max_p99),
+        ("gpu_memory_mb", args.max_gpu_mb),
+        ("bindings_per_instance", args.max_bindings),
+    )
+    for key, limit in limits:
+        if limit is not None and result[key] > limit:
+            failures.append(
+                "{} = {:.2f} > {:.2f}".format(key, result[key], limit)
+            )
+    return failures
+
+
+def check_baseline(result, baseline, tolerance):
+    failures = []
+    for key in ("p95", "p99", "gpu_memory_mb", "bindings_per_instance"):
+        if key not in baseline:
+            continue
+        limit = baseline[key] * (1 + tolerance)
+        if result[key] > limit:
+            failures.append(
+                "{} = {:.2f} > {:.2f} (baseline {:.2f} + {:.0%})".format(
+                    key, result[key], limit, baseline[key], tolerance
+                )
+            )
+    return failures
+
+
+def parse_list(value, cast=str):
+    return [cast(v) for v in value.split(",") if v]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="FrostedGlass scaling stress test."
+    )
+    parser.add_argument(
+        "--counts", type=lambda v: parse_list(v, int), default=list(COUNTS),
+        help="comma separated numbers of instances (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--backgrounds", type=parse_list, default=list(BACKGROUNDS),
+        help="comma separated backgrounds among: " + ", ".join(BACKGROUNDS),
+    )
+    parser.add_argument(
+        "--frames", type=int, default=120,
+        help="measured frames per scenario (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=20,
+        help="frames run before measuring (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--backend", default="auto", choices=("auto", "gpu", "cpu"),
+        help="FrostedGlass.blur_backend (default: %(default)s)",
+    )
+    parser.add_argument("--max-p95", type=float, help="frame time, in ms")
+    parser.add_argument("--max-p99", type=float, help="frame time, in ms")
+    parser.add_argument("--max-gpu-mb", type=float)
+    parser.add_argument(
+        "--max-bindings", type=float, help="bindings per instance"
+    )
+    parser.add_argument(
+        "--baseline", help="JSON results to compare with"
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2,
+        help="allowed regression compared to the baseline, as a fraction "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--save-baseline", help="save the results as JSON to this file"
+    )
+    args = parser.parse_args(argv)
+    if args.frames < 1:
+        parser.error("--frames must be at least 1")
+    if args.warmup < 0:
+        parser.error("--warmup must not be negative")
+    unknown = set(args.backgrounds) - set(BACKGROUNDS)
+    if unknown:
+        parser.error("unknown backgrounds: " + ", ".join(sorted(unknown)))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    EventLoop.ensure_window()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+
+    results = {}
+    failed = False
+    header = "{:<16} {:>6} {:>8} {:>8} {:>8} {:>8} {:>10} {:>9}".format(
+        "scenario", "ready", "p50", "p95", "p99", "max", "bindings", "GPU MB"
+    )
+    print(header)
+    print("-" * len(header))
+    for background_name in args.backgrounds:
+        for count in args.counts:
+            name = "{}-{}".format(background_name, count)
+            result = run_scenario(
+                background_name, count, args.frames, args.warmup,
+                args.backend,
+            )
+            results[name] = result
+            print(
+                "{:<16} {ready_frames:>6} {p50:>8.2f} {p95:>8.2f} "
+                "{p99:>8.2f} {max:>8.2f} "
+                "{bindings:>10} {gpu_memory_mb:>9.2f}".format(name, **result)
+            )
+            failures = check_thresholds(result, args)
+            if name in baseline:
+                failures += check_baseline(
+                    result, baseline[name], args.tolerance
+                )
+            for failure in failures:
+                print("  FAILED: " + failure)
+            failed = failed or bool(failures)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as fh:
+            json.dump(results, fh, indent=2)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,13 +18,19 @@ from ._version import __version__
 import kivy
 kivy.require('2.2.0')
 
+import math
 import os
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from time import perf_counter as now
+from weakref import WeakKeyDictionary, WeakSet
 
+from kivy.base import EventLoop
 from kivy.clock import Clock
 from kivy.core.window import Window
 from kivy.graphics import (
     BindTexture,
+    Canvas,
     ClearBuffers,
     ClearColor,
     Color,
@@ -36,12 +42,16 @@ from kivy.graphics import (
     SmoothLine,
     Translate,
 )
+from kivy.graphics.texture import Texture
+from kivy.logger import Logger
 from kivy.metrics import dp
 from kivy.properties import (
+    BooleanProperty,
     ColorProperty,
     ListProperty,
     NumericProperty,
     ObjectProperty,
+    OptionProperty,
 )
 from kivy.uix.floatlayout import FloatLayout
 
@@ -52,8 +62,141 @@ from kivy.uix.screenmanager import Screen
 from kivy.uix.scrollview import ScrollView
 from kivy.uix.video import Video
 
+from . import _cpu_blur, profiling
+from .initialization import initializer
+from .memory import MEMORY_LEVELS, gpu_memory, texture_bytes
+
 MEAN_RES = (Window.width + Window.height) / 2
 
+# Maximum time (in seconds) spent walking widget trees per frame, shared by
+# the scans of all the instances. Deep trees are collected across several
+# frames so they don't block the first one.
+TREE_SCAN_BUDGET = 0.002
+# (frame, time of the first scan in this frame)
+_tree_scan_start = (None, 0)
+
+
+def _get_tree_scan_deadline():
+    """Returns the time at which the scans must stop in the current frame."""
+    global _tree_scan_start
+    frame, start = _tree_scan_start
+    if frame != Clock.frames:
+        start = now()
+        _tree_scan_start = (Clock.frames, start)
+    return start + TREE_SCAN_BUDGET
+
+
+# Instances whose effect is currently visible. While it's empty, there is no
+# need to force the window to redraw every frame.
+_visible_instances = WeakSet()
+
+
+def _ask_window_update(dt):
+    if _visible_instances:
+        Window.canvas.ask_update()
+
+
+# Instances whose blur must be rendered in the next flush of the scheduler.
+_dirty_instances = WeakSet()
+_last_render_cycle = frozenset()
+# (dependents of each visible instance, its rank in the render order), see
+# _get_render_graph.
+_render_graph = None
+
+
+def _schedule_render(instance):
+    _dirty_instances.add(instance)
+    _render_ev()
+
+
+def _get_render_order(instances):
+    """Sorts ``instances`` (Kahn's algorithm) so that each FrostedGlass comes
+    after the ones in its background tree. Returns the sorted instances, the
+    dependents of each instance and the instances that are part of a cycle.
+    """
+    dependents = {fg: [] for fg in instances}
+    in_degree = dict.fromkeys(dependents, 0)
+    for fg in dependents:
+        for widget in fg.background_children_list:
+            if widget is not fg and widget in dependents:
+                dependents[widget].append(fg)
+                in_degree[fg] += 1
+
+    queue = deque(fg for fg, degree in in_degree.items() if not degree)
+    order = []
+    while queue:
+        fg = queue.popleft()
+        order.append(fg)
+        for dependent in dependents[fg]:
+            in_degree[dependent] -= 1
+            if not in_degree[dependent]:
+                queue.append(dependent)
+
+    cycle = [fg for fg, degree in in_degree.items() if degree]
+    return order, dependents, cycle
+
+
+def _invalidate_render_graph():
+    """Must be called when an instance becomes visible or hidden, or when
+    its background tree changes."""
+    global _render_graph
+    _render_graph = None
+
+
+def _get_render_graph():
+    """Returns the dependents of each visible instance and its rank in the
+    render order. They are only sorted again after a change of the visible
+    instances or of their background trees."""
+    global _last_render_cycle, _render_graph
+    if _render_graph is None:
+        order, dependents, cycle = _get_render_order(
+            list(_visible_instances)
+        )
+        if frozenset(cycle) != _last_render_cycle:
+            _last_render_cycle = frozenset(cycle)
+            if cycle:
+                Logger.warning(
+                    "FrostedGlass: Cycle between the backgrounds of {} "
+                    "instances, they are rendered in no particular "
+                    "order.".format(len(cycle))
+                )
+        rank = {fg: index for index, fg in enumerate(order + cycle)}
+        _render_graph = (dependents, rank)
+    return _render_graph
+
+
+def _render_dirty_instances(*args):
+    """Renders the blur of all the dirty instances once, in dependency order,
+    so a FrostedGlass that uses another one as background blurs its result
+    from the current frame. Dependents of a rendered instance are rendered
+    too."""
+    # The first flush is done in the next frame, so the background is drawn
+    # at least once. The next ones are done before the current frame ends.
+    _render_ev.timeout = -1
+    if not _dirty_instances:
+        return
+
+    dependents, rank = _get_render_graph()
+    # Only the dirty instances and their dependents are walked.
+    stack = [fg for fg in _dirty_instances if fg in rank]
+    _dirty_instances.clear()
+    dirty = set()
+    while stack:
+        fg = stack.pop()
+        if fg not in dirty:
+            dirty.add(fg)
+            stack.extend(dependents[fg])
+
+    for fg in sorted(dirty, key=rank.__getitem__):
+        fg._set_final_texture()
+        for dependent in dependents[fg]:
+            # The result of ``fg`` may have changed without changing the
+            # fingerprint of its dependents.
+            dependent._force_render = True
+
+
+_render_ev = Clock.create_trigger(_render_dirty_instances, 0)
+
 
 vertical_blur_shader = """
 #ifdef GL_ES
@@ -195,45 +338,90 @@ final_shader_effect = """
 
 $HEADER$
 
+$DEFINES$
+
 uniform int add_child_texture;
 uniform float opacity;
 uniform float luminosity;
 uniform float saturation;
 uniform float noise_opacity;
+uniform float level_mix;
 uniform vec2 position;
 uniform vec2 resolution;
 uniform vec4 color_overlay;
 uniform sampler2D texture1;
 uniform sampler2D texture2;
+uniform sampler2D texture3;
 
 void main(void)
 {
-    vec2 pos = (gl_FragCoord.xy - position.xy) / resolution.xy;
-    float noise = 0.0;
-    vec4 textureResult = vec4(0.0);
-    vec4 effect_texture = texture2D(texture1, pos);
-    vec4 noise_texture = texture2D(texture2, tex_coord0);
+    vec4 effect_texture = vec4(0.0, 0.0, 0.0, 1.0);
+    float alpha = opacity;
+
+#ifdef USE_PLACEHOLDER
+    effect_texture = vec4(color_overlay.rgb, 1.0);
+    alpha *= color_overlay.a;
+#endif
 
+#ifdef USE_BLUR
+    vec2 pos = (gl_FragCoord.xy - position.xy) / resolution.xy;
+#ifdef USE_IMAGE_LEVELS
+    effect_texture = mix(
+        texture2D(texture1, pos), texture2D(texture3, pos), level_mix
+    );
+#else
+    effect_texture = texture2D(texture1, pos);
+#endif
+#ifdef USE_SATURATION
     const vec3 W = vec3(0.2125, 0.7154, 0.0721);
     vec3 intensity = vec3(dot(effect_texture.rgb, W));
     effect_texture = vec4(mix(intensity, effect_texture.rgb, saturation), 1.0);
+#endif
+#ifdef USE_LUMINOSITY
     effect_texture *= luminosity;
+#endif
+#endif
 
+#ifdef USE_OVERLAY
     effect_texture = mix(
         effect_texture.rgba,
         vec4(color_overlay.rgb, 1.0),
         min(1.0, color_overlay.a)
     );
+#endif
+
+#ifdef USE_NOISE
+    vec4 noise_texture = texture2D(texture2, tex_coord0);
     effect_texture = mix(
         effect_texture.rgba,
         vec4(noise_texture.rgb, 1.0),
         min(1.0, noise_opacity)
     );
+#endif
 
-    gl_FragColor = vec4(effect_texture.rgb, opacity);
+    gl_FragColor = vec4(effect_texture.rgb, alpha);
 }
 """
 
+# Sources of the final shader, per variant (the stages it enables). Kivy
+# compiles a program per RenderContext and can't share it between instances,
+# so only the sources are shared, and each instance only recompiles its shader
+# when its variant changes.
+_final_shader_sources = {}
+
+
+# Shown until the effect is ready, see :mod:`.initialization`.
+PLACEHOLDER_VARIANT = ("USE_PLACEHOLDER",)
+
+
+def _get_final_shader_source(variant):
+    source = _final_shader_sources.get(variant)
+    if source is None:
+        defines = "\n".join("#define {}".format(name) for name in variant)
+        source = final_shader_effect.replace("$DEFINES$", defines)
+        _final_shader_sources[variant] = source
+    return source
+
 
 class VerticalBlur(Fbo):
     def __init__(self, *args, **kwargs):
@@ -260,6 +448,187 @@ class Noise(Fbo):
         self.rect = Rectangle()
 
 
+# Size of the noise texture shared by the instances downgraded to the
+# "shared_noise" memory level, see :mod:`.memory`.
+SHARED_NOISE_SIZE = (256, 256)
+_shared_noise = None
+
+
+def _get_shared_noise_texture():
+    global _shared_noise
+    if _shared_noise is None:
+        _shared_noise = Noise(size=SHARED_NOISE_SIZE)
+        _shared_noise.rect.size = SHARED_NOISE_SIZE
+        _shared_noise.add(_shared_noise.rect)
+        _shared_noise.draw()
+        gpu_memory.update_shared(
+            "shared_noise", texture_bytes(SHARED_NOISE_SIZE)
+        )
+    return _shared_noise.texture
+
+
+# Pre-blurred levels of the textures of Image backgrounds, see
+# _get_image_levels. The least recently used chains are released when there
+# are more than IMAGE_LEVELS_CACHE_SIZE.
+IMAGE_LEVELS_CACHE_SIZE = 8
+IMAGE_LEVEL_MAX_SIZE = 512
+IMAGE_LEVEL_MIN_SIZE = 4
+_image_levels_cache = OrderedDict()
+
+
+def _draw_texture(fbo, texture):
+    with fbo:
+        ClearColor(0, 0, 0, 0)
+        ClearBuffers()
+        Rectangle(texture=texture, size=fbo.size)
+    fbo.draw()
+    return fbo.texture
+
+
+def _build_image_levels(texture):
+    """Returns a chain of textures: ``texture`` downscaled to at most
+    :data:`IMAGE_LEVEL_MAX_SIZE`, then each level blurred and downscaled by
+    2 from the previous one, so level ``i`` is blurred with a standard
+    deviation of ``sqrt(4 ** i - 1)`` pixels of level 0."""
+    width, height = texture.size
+    scale = min(1, IMAGE_LEVEL_MAX_SIZE / max(width, height, 1))
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    levels = [_draw_texture(Fbo(size=size), texture)]
+    while max(size) > IMAGE_LEVEL_MIN_SIZE:
+        source = levels[-1]
+        size = (max(1, size[0] // 2), max(1, size[1] // 2))
+        # Each pass samples 13 taps spaced by half a pixel of the source.
+        h_blur = HorizontalBlur(size=(size[0], source.height))
+        h_blur["mean_res"] = 1.0
+        h_blur["blur_size"] = 2.0 / source.width
+        v_blur = VerticalBlur(size=size)
+        v_blur["mean_res"] = 1.0
+        v_blur["blur_size"] = 2.0 / source.height
+        levels.append(
+            _draw_texture(v_blur, _draw_texture(h_blur, source))
+        )
+    return levels
+
+
+def _get_image_levels(image):
+    key = (image.source, tuple(image.texture.size))
+    levels = _image_levels_cache.pop(key, None)
+    if levels is None:
+        levels = _build_image_levels(image.texture)
+    _image_levels_cache[key] = levels
+    while len(_image_levels_cache) > IMAGE_LEVELS_CACHE_SIZE:
+        _image_levels_cache.popitem(last=False)
+    gpu_memory.update_shared(
+        "image_levels",
+        sum(
+            texture_bytes(level.size)
+            for chain in _image_levels_cache.values()
+            for level in chain
+        ),
+    )
+    return levels
+
+
+def _widget_kind(widget):
+    """Classifies a widget according to the kind of bindings it requires."""
+    if isinstance(widget, ScrollView):
+        return "scrollview"
+    if isinstance(widget, ModalView):
+        return "modalview"
+    if isinstance(widget, Screen):
+        return "screen"
+    if isinstance(widget, Video):
+        return "video"
+    if isinstance(widget, Image):
+        return "image"
+    return None
+
+
+def _iter_kinds(widgets):
+    """Yields each widget of ``widgets`` with its kind, so the widgets are
+    classified by the walk that collects them."""
+    for widget in widgets:
+        yield widget, _widget_kind(widget)
+
+
+def _iter_parents(widget):
+    parent = widget
+    while True:
+        yield parent
+        if parent.parent and parent != parent.parent:
+            parent = parent.parent
+        else:
+            break
+
+
+def _iter_children(widget):
+    yield widget
+    children_widgets = [widget]
+    while children_widgets:
+        parent_widgets = children_widgets
+        children_widgets = []
+        for w in parent_widgets:
+            if w.children:
+                yield from w.children
+                children_widgets.extend(w.children)
+
+
+def _widget_fingerprint(widget, kind):
+    """Returns what determines how ``widget``, of the given ``kind`` (see
+    :func:`_widget_kind`), is drawn, or None if it doesn't draw anything
+    itself."""
+    canvas = widget.canvas
+    instructions = len(canvas.children)
+    if canvas.has_before:
+        instructions += len(canvas.before.children)
+    if canvas.has_after:
+        instructions += len(canvas.after.children)
+    if not instructions:
+        return None
+
+    texture = getattr(widget, "texture", None)
+    if kind == "video":
+        state = widget.position
+    elif kind == "scrollview":
+        state = (widget.scroll_x, widget.scroll_y)
+    else:
+        state = None
+    return (
+        id(widget),
+        tuple(widget.pos),
+        tuple(widget.size),
+        None if texture is None else id(texture),
+        state,
+        instructions,
+    )
+
+
+# background: (Clock.frames, fingerprint of its content)
+_content_fingerprints = WeakKeyDictionary()
+
+
+def _get_content_fingerprint(background, widgets, kinds):
+    """Returns the fingerprint of the widgets drawn in the tree of
+    ``background``. It's computed once per frame, for all the instances that
+    share this background."""
+    frame, content = _content_fingerprints.get(background, (None, None))
+    if frame != Clock.frames:
+        fingerprints = (
+            _widget_fingerprint(widget, kinds.get(widget))
+            for widget in widgets
+        )
+        content = (
+            background.to_window(*background.pos),
+            tuple(
+                fingerprint
+                for fingerprint in fingerprints
+                if fingerprint is not None
+            ),
+        )
+        _content_fingerprints[background] = (Clock.frames, content)
+    return content
+
+
 class FrostedGlass(FloatLayout):
 
     background = ObjectProperty(None, allownone=True)
@@ -322,26 +691,110 @@ class FrostedGlass(FloatLayout):
     :attr:`outline_width` is a :class:`~kivy.properties.NumericProperty` and
     defaults to 1."""
 
+    scroll_margin = NumericProperty(50)
+    """Margin added around a FrostedGlass placed inside a
+    :class:`~kivy.uix.scrollview.ScrollView` to the region of the background
+    that is blurred. When scrolling over a static background, the blurred
+    region is reused and the effect is only re-blurred when FrostedGlass
+    moves past this margin. Set it to 0 to re-blur on every scroll.
+
+    Note: Do not pass relative values such as dp or sp. FrostedGlass already
+    manages this automatically, according to the device's screen density.
+
+    :attr:`scroll_margin` is a :class:`~kivy.properties.NumericProperty` and
+    defaults to 50."""
+
+    idle_release_timeout = NumericProperty(5)
+    """Time (in seconds) after which the Fbos of a hidden FrostedGlass are
+    released. They are allocated again when it becomes visible. Set it to -1
+    to keep the Fbos while hidden.
+
+    :attr:`idle_release_timeout` is a :class:`~kivy.properties.NumericProperty`
+    and defaults to 5."""
+
+    blur_backend = OptionProperty("auto", options=["auto", "gpu", "cpu"])
+    """Backend used to blur the background. "gpu" uses the blur shaders and
+    "cpu" a box blur computed with NumPy (which must be installed), whose
+    cost doesn't depend on the blur size. "auto" uses "cpu" when OpenGL runs
+    on a software renderer, such as llvmpipe or SwiftShader, and NumPy is
+    installed, and "gpu" otherwise.
+
+    :attr:`blur_backend` is an :class:`~kivy.properties.OptionProperty` and
+    defaults to "auto"."""
+
+    image_levels = BooleanProperty(True)
+    """Whether the blur of a plain, static :class:`~kivy.uix.image.Image`
+    background (with a source, no children, no tint, not animated and not
+    clipped by the "cover" fit mode) is sampled from a chain of pre-blurred
+    levels of its texture, built once per source and shared by all the
+    instances, instead of blurring the background. The two levels closest to
+    :attr:`blur_size` are mixed, so changing or animating it is nearly free.
+    The result is close to the regular blur, but isotropic.
+
+    :attr:`image_levels` is a :class:`~kivy.properties.BooleanProperty` and
+    defaults to True."""
+
+    effect_visible = BooleanProperty(False)
+    """Indicates whether the effect is visible. FrostedGlass is considered
+    hidden when it isn't in the window's widget tree, is outside the window or
+    the viewport of a parent :class:`~kivy.uix.scrollview.ScrollView`, is in a
+    closed :class:`~kivy.uix.modalview.ModalView` or a
+    :class:`~kivy.uix.screenmanager.Screen` that isn't the current one, or
+    when its effective opacity is 0. While hidden, the background bindings and
+    all the rendering work are suspended.
+
+    :attr:`effect_visible` is a :class:`~kivy.properties.BooleanProperty`,
+    read-only, and defaults to False."""
+
+    memory_level = OptionProperty("full", options=MEMORY_LEVELS)
+    """Quality level of the effect, lowered when the GPU memory budget of
+    :data:`~kivy_garden.frostedglass.memory.gpu_memory` is exceeded: "full",
+    "reduced" (Fbos with half the resolution), "shared_noise" (noise texture
+    shared with other instances) or "static" (the last blurred result is
+    kept, and no longer updated). It's restored to "full" when the Fbos are
+    released or the budget changes.
+
+    :attr:`memory_level` is an :class:`~kivy.properties.OptionProperty`,
+    read-only, and defaults to "full"."""
+
+    effect_ready = BooleanProperty(False)
+    """Indicates whether the effect has been initialized. Until then, only a
+    flat :attr:`overlay_color` is drawn over the background. The initialization
+    starts when FrostedGlass becomes visible, and is spread across frames by
+    :data:`~kivy_garden.frostedglass.initialization.initializer`.
+
+    :attr:`effect_ready` is a :class:`~kivy.properties.BooleanProperty`,
+    read-only, and defaults to False."""
+
     def __init__(self, **kwargs):
-        super().__init__(**kwargs)
+        # The effect is set up before the properties passed as arguments or
+        # by kv rules are applied, as their handlers use it.
+        EventLoop.ensure_window()
+        self.canvas = Canvas()
+        self._batch_depth = 0
+        self._batch_pending = set()
         fbind = self.fbind
         fbind("outline_width", self._update_canvas)
         fbind("outline_color", self._update_canvas)
         fbind("border_radius", self._update_canvas)
-        fbind("noise_opacity", self.update_effect)
-        fbind("luminosity", self.update_effect)
-        fbind("saturation", self.update_effect)
-        fbind("overlay_color", self.update_effect)
-        fbind("border_radius", self.update_effect)
-
+        fbind("noise_opacity", self._update_effect)
+        fbind("luminosity", self._update_effect)
+        fbind("saturation", self._update_effect)
+        fbind("overlay_color", self._update_effect)
+        fbind("scroll_margin", self.refresh_effect)
+        fbind("blur_backend", self.refresh_effect)
+        fbind("image_levels", self.refresh_effect)
+
+        self._shader_variant = self._get_shader_variant()
         self.frosted_glass_effect = RenderContext(
             use_parent_projection=True,
             use_parent_modelview=True,
-            fs=final_shader_effect
+            fs=_get_final_shader_source(PLACEHOLDER_VARIANT)
         )
         with self.frosted_glass_effect:
             self.bt_1 = BindTexture(index=1)
             self.bt_2 = BindTexture(index=2)
+            self.bt_3 = BindTexture(index=3)
             self.fbo_rect = RoundedRectangle(
                 size=self.size,
                 pos=self.pos,
@@ -349,8 +802,11 @@ class FrostedGlass(FloatLayout):
             )
         self.frosted_glass_effect["texture1"] = 1
         self.frosted_glass_effect["texture2"] = 2
+        self.frosted_glass_effect["texture3"] = 3
+        self._update_texture_bindings()
 
         self.canvas.add(self.frosted_glass_effect)
+        profiling.register(self)
 
         with self.canvas:
             self._outline_color = Color(rgba=self.outline_color)
@@ -364,9 +820,13 @@ class FrostedGlass(FloatLayout):
                 ),
             )
 
-        self.noise = Noise(size=(100, 100))
-        self.h_blur = HorizontalBlur(size=(100, 100))
-        self.v_blur = VerticalBlur(size=(100, 100))
+        # The Fbos are allocated when the effect becomes visible.
+        self.noise = Noise(size=(1, 1))
+        self.h_blur = HorizontalBlur(size=(1, 1))
+        self.v_blur = VerticalBlur(size=(1, 1))
+        # Background captured without blur, for the CPU blur backend.
+        self.capture = Fbo(size=(1, 1))
+        self._cpu_texture = None
 
         with self.h_blur:
             ClearColor(0, 0, 0, 0)
@@ -380,124 +840,672 @@ class FrostedGlass(FloatLayout):
             self.v_blur_scale = Scale(1, 1, 1)
             self.v_blur_translate = Translate(0, 0)
 
-        self.last_value = 0
-        self.last_update_time = 0
-        self.last_value_list = [0, 0]
+        with self.capture:
+            ClearColor(0, 0, 0, 0)
+            ClearBuffers()
+            self.capture_scale = Scale(1, 1, 1)
+            self.capture_translate = Translate(0, 0)
+
+        self.fingerprint_hits = 0
+        self.fingerprint_misses = 0
+        self._force_render = True
+        self._rendered_fingerprint = None
         self.last_blur_size_value = None
-        self.last_fbo_pos = [None, None]
         self._pos = [0, 0]
+        self._blur_region = (0, 0, 0, 0)
+        self._blur_dirty = True
+        self._transition_screen = None
         self.popup_parent = None
         self.parent_screen = None
         self.parents_list = []
         self.background_children_list = []
         self.background_parents_list = []
+        # Kinds of the widgets of the lists above, see _widget_kind.
+        self._parent_kinds = {}
+        self._background_kinds = {}
         self._last_background_canvas = None
+        self._tree_scan_events = {}
+        self._in_window = False
+        self._fbos_released = True
+        self._noise_dirty = True
+        self._initializing = False
 
         self.is_movable = False
-        self.adapted_fbo_size = False
 
         self._update_glsl_ev = Clock.create_trigger(self._update_glsl, 0)
         self._update_fbo_ev = Clock.create_trigger(self._update_fbo_effect, 0)
-        self._update_texture_ev = Clock.create_trigger(
-            self._set_final_texture, 0
+        self._capture_transition_ev = Clock.create_trigger(
+            self._capture_transition_snapshot, -1
         )
-        self._refresh_effect_ev = Clock.create_trigger(
-            self.refresh_effect, 0.033333, True
+        self._update_visibility_ev = Clock.create_trigger(
+            self._update_visibility, -1
         )
+        self._idle_release_ev = Clock.create_trigger(self._release_fbos)
+
+        super().__init__(**kwargs)
+        self._account_memory()
+        initializer.track(self)
 
         if not os.environ.get("FG_ASK_UPDATE_CANVAS_ACTIVE"):
             os.environ["FG_ASK_UPDATE_CANVAS_ACTIVE"] = "1"
-            Clock.schedule_interval(lambda dt: Window.canvas.ask_update(), 0)
+            Clock.schedule_interval(_ask_window_update, 0)
 
     def update_effect(self, *args):
+        """Updates the effect, blurring the background again even if the
+        changes can't be detected, such as a change of the canvas
+        instructions of a background widget that keeps its position and
+        size."""
+        self._force_render = True
+        self._update_effect()
+
+    def _update_effect(self, *args):
+        """Updates the effect after a change of its properties or of the
+        background. The background is only blurred again if the fingerprint
+        of the content under FrostedGlass has changed."""
+        if self._batch_depth:
+            self._batch_pending.add("_update_effect")
+            return
+        self._blur_dirty = True
         self._update_glsl_ev()
 
     def refresh_effect(self, *args):
+        self._force_render = True
         self._update_fbo_ev()
         self._update_glsl_ev()
 
+    @contextmanager
+    def batch(self):
+        """Context manager that collapses the updates caused by setting
+        several properties: the canvas and the effect are only updated once,
+        when the outermost batch exits.
+
+        Example::
+
+            with frosted_glass.batch():
+                frosted_glass.luminosity = 1.1
+                frosted_glass.overlay_color = (0, 0, 0, 0.3)
+                frosted_glass.border_radius = (dp(10),) * 4
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                pending = self._batch_pending
+                self._batch_pending = set()
+                if "_update_canvas" in pending:
+                    self._update_canvas()
+                if "_update_effect" in pending:
+                    self._update_effect()
+
+    @classmethod
+    def apply_theme(cls, instances, **props):
+        """Sets ``props`` on all the FrostedGlass ``instances``, with a single
+        canvas and effect update per instance.
+
+        Example::
+
+            FrostedGlass.apply_theme(
+                glasses, overlay_color=(0, 0, 0, 0.4), luminosity=0.9
+            )
+        """
+        for instance in instances:
+            with instance.batch():
+                for name, value in props.items():
+                    setattr(instance, name, value)
+
     def _update_glsl(self, *args):
-        self._pos = self.to_window(*self.pos)
+        self._pos = self._get_window_pos()
+        if not self.effect_visible and not self.in_transition:
+            return
+
+        self._update_uniforms()
+        if self._init_pending:
+            return
+
+        if self.in_transition:
+            # The snapshot taken when the transition started is reused, and
+            # only captured again if the background itself has changed.
+            self._update_position_uniform()
+            if self._blur_dirty:
+                self._capture_transition_ev()
+            return
+
+        if not self.uses_blur or self.memory_level == "static":
+            return
+
         if (
-            self.not_current_screen
-            or self.out_of_the_window
-            and self.background_loaded
+            not self._blur_dirty
+            and self.scroll_cache_enabled
+            and self._blur_region_contains_glass()
         ):
+            # Only FrostedGlass moved, over a static background, and the
+            # blurred region still covers it.
             return
 
+        self._set_blur_region(self._get_blur_region())
+        _schedule_render(self)
+
+    def _update_uniforms(self):
         effect = self.frosted_glass_effect
-        effect["position"] = [float(v) for v in self._pos]
-        effect["resolution"] = [float(v) for v in self.size]
         effect["luminosity"] = float(self.luminosity)
         effect["saturation"] = float(self.saturation)
         effect["noise_opacity"] = float(self.noise_opacity)
         effect["color_overlay"] = [float(v) for v in self.overlay_color]
+        self._update_shader_variant()
 
-        if self.is_movable:
-            if not self.adapted_fbo_size:
-                self.refresh_effect()
-                self.adapted_fbo_size = True
+    @property
+    def _init_pending(self):
+        """Whether the work related to the effect is deferred until the
+        initializer runs the initialization steps."""
+        return not self.effect_ready and not self._initializing
+
+    def _iter_init_steps(self):
+        """Steps run by the initializer, each one in a single frame. Yields
+        True while waiting for the scan of the background tree."""
+        self._pos = self._get_window_pos()
+        self._update_uniforms()
+        yield
+        if self.uses_noise:
+            self._update_noise_texture()
+            yield
+        while self.tree_scan_pending:
+            yield True
+        if self.background and self.uses_blur:
+            # During a Screen transition, this is its snapshot.
+            self._setup_fbos()
+            yield
+            self._set_final_texture()
+            yield
+        self.effect_ready = True
+
+    def on_effect_ready(self, _, ready):
+        if ready:
+            self.frosted_glass_effect.shader.fs = _get_final_shader_source(
+                self._shader_variant
+            )
+            self._update_texture_bindings()
+            # Catches up with the changes made during the initialization.
+            self._update_glsl_ev()
+
+    def _get_shader_variant(self):
+        """Returns the stages of the final shader required by the current
+        parameters. The blur is skipped when it is fully covered by the
+        overlay or the noise."""
+        overlay_alpha = self.overlay_color[3]
+        variant = []
+        if overlay_alpha < 1 and self.noise_opacity < 1:
+            variant.append("USE_BLUR")
+            if self.saturation != 1:
+                variant.append("USE_SATURATION")
+            if self.luminosity != 1:
+                variant.append("USE_LUMINOSITY")
+            if self._image_levels_source is not None:
+                variant.append("USE_IMAGE_LEVELS")
+        if overlay_alpha > 0:
+            variant.append("USE_OVERLAY")
+        if self.noise_opacity > 0:
+            variant.append("USE_NOISE")
+        return tuple(variant)
+
+    def _update_shader_variant(self):
+        variant = self._get_shader_variant()
+        if variant == self._shader_variant:
+            return
 
-            self.h_blur_translate.x = self.v_blur_translate.x = -self._pos[0]
-            self.h_blur_translate.y = self.v_blur_translate.y = (
-                -self._pos[1] - self.size[1]
+        if ("USE_IMAGE_LEVELS" in variant) != self.uses_image_levels:
+            # The Fbos used by the blur must be set up again.
+            self._blur_region = (0, 0, 0, 0)
+        self._shader_variant = variant
+        if not self.uses_blur and self.memory_level != "static":
+            # The static texture is kept for when the blur is used again.
+            self._release_blur_fbos()
+        if self.effect_ready:
+            self.frosted_glass_effect.shader.fs = _get_final_shader_source(
+                variant
             )
+        self._update_texture_bindings()
+        if self.uses_noise:
+            if self._noise_dirty:
+                self._update_noise_texture()
+        else:
+            self.bt_2.texture = None
+            self.noise.size = (1, 1)
+            self._noise_dirty = True
+            self._account_memory()
+
+    def _release_blur_fbos(self):
+        """Shrinks the Fbos used by the blur while it's fully covered by the
+        overlay or the noise. They are set up again when the blur is used."""
+        _dirty_instances.discard(self)
+        self.bt_1.texture = None
+        self.bt_3.texture = None
+        self.h_blur.rect.texture = None
+        self._cpu_texture = None
+        for fbo in (self.h_blur, self.v_blur, self.capture):
+            fbo.size = (1, 1)
+        self._blur_region = (0, 0, 0, 0)
+        self._account_memory()
+
+    def _update_texture_bindings(self):
+        """Only binds the textures sampled by the current shader variant."""
+        effect = self.frosted_glass_effect
+        for bind_texture, used in (
+            (self.bt_1, self.uses_blur),
+            (self.bt_2, self.uses_noise),
+            (self.bt_3, self.uses_image_levels),
+        ):
+            used = used and self.effect_ready
+            bound = bind_texture in effect.children
+            if used and not bound:
+                effect.insert(0, bind_texture)
+            elif bound and not used:
+                effect.remove(bind_texture)
+
+    @property
+    def uses_blur(self):
+        return "USE_BLUR" in self._shader_variant
+
+    @property
+    def uses_noise(self):
+        return "USE_NOISE" in self._shader_variant
+
+    @property
+    def uses_image_levels(self):
+        return "USE_IMAGE_LEVELS" in self._shader_variant
 
-        self._update_texture_ev()
+    @property
+    def _image_levels_source(self):
+        """Returns the background if it's a plain, static
+        :class:`~kivy.uix.image.Image` whose blur can be sampled from
+        pre-blurred levels of its texture, None otherwise. With the "cover"
+        fit mode, the texture is clipped to the bounds of the Image, so it
+        is blurred as any other background."""
+        image = self.background
+        if (
+            not self.image_levels
+            or not isinstance(image, Image)
+            or isinstance(image, Video)
+            or not image.source
+            or image.texture is None
+            or image.fit_mode == "cover"
+            or tuple(image.color) != (1, 1, 1, 1)
+            or self.background_children_list != [image]
+            or image.canvas.has_before
+            or image.canvas.has_after
+        ):
+            return None
+        core_image = getattr(image, "_coreimage", None)
+        if getattr(core_image, "anim_available", False):
+            return None
+        return image
+
+    @property
+    def scroll_cache_enabled(self):
+        """Whether the blurred region can be reused while scrolling, which
+        requires the background to not be moved by the same ScrollView."""
+        if not self.is_movable or self.scroll_margin <= 0:
+            return False
+        background_parents = self.background_parents_list
+        return not any(
+            p in background_parents
+            for p in self.parents_list
+            if isinstance(p, ScrollView)
+        )
+
+    def _get_blur_region(self):
+        """Returns the region of the window (x, y, width, height) that will be
+        blurred: the area of FrostedGlass, plus :attr:`scroll_margin` when the
+        blurred region can be reused while scrolling, or the area where the
+        texture of an Image background is displayed."""
+        if self.uses_image_levels:
+            return self._get_image_rect()
+        margin = dp(self.scroll_margin) if self.scroll_cache_enabled else 0
+        x, y = self._pos
+        return (
+            x - margin,
+            y - margin,
+            max(1, self.width) + 2 * margin,
+            max(1, self.height) + 2 * margin,
+        )
+
+    def _blur_region_contains_glass(self):
+        x, y, width, height = self._blur_region
+        return (
+            x <= self._pos[0]
+            and y <= self._pos[1]
+            and self._pos[0] + self.width <= x + width
+            and self._pos[1] + self.height <= y + height
+        )
+
+    def _get_image_rect(self):
+        """Returns the area of the window where the texture of the Image
+        background is displayed, once any ongoing transition finishes."""
+        image = self.background
+        width, height = image.norm_image_size
+        x, y = image.to_window(
+            image.center_x - width / 2, image.center_y - height / 2
+        )
+        if self._transition_screen in self.background_parents_list:
+            offset_x, offset_y = self._transition_offset
+            x, y = x - offset_x, y - offset_y
+        return x, y, max(1, width), max(1, height)
+
+    def _set_blur_region(self, region):
+        x, y, width, height = region
+        if (width, height) != tuple(self._blur_region[2:]):
+            self._blur_region = region
+            self._setup_fbos()
+            return
+
+        self._blur_region = region
+        self.h_blur_translate.x = self.v_blur_translate.x = -x
+        self.h_blur_translate.y = self.v_blur_translate.y = -y - height
+        # Unlike the blur Fbos, which are drawn on top of each other, the
+        # capture isn't flipped.
+        self.capture_translate.x = -x
+        self.capture_translate.y = -y
+
+        self.frosted_glass_effect["resolution"] = [float(width), float(height)]
+        self._update_position_uniform()
+
+    def _update_position_uniform(self):
+        x, y = self._blur_region[:2]
+        offset_x, offset_y = self._transition_offset
+        self.frosted_glass_effect["position"] = [
+            float(x + offset_x),
+            float(y + offset_y),
+        ]
+
+    def _get_window_pos(self):
+        """Returns the position of FrostedGlass in the window, once any
+        ongoing :class:`~kivy.uix.screenmanager.Screen` transition finishes.
+        """
+        x, y = self.to_window(*self.pos)
+        offset_x, offset_y = self._transition_offset
+        return x - offset_x, y - offset_y
+
+    @property
+    def in_transition(self):
+        return self._transition_screen is not None
+
+    @property
+    def _transition_offset(self):
+        screen = self._transition_screen
+        if screen is None or screen.manager is None:
+            return 0, 0
+        return screen.x - screen.manager.x, screen.y - screen.manager.y
+
+    def _set_final_texture(self, *args):
+        if not self.background or not self.effect_visible:
+            return
+        if (
+            not self.uses_blur
+            or self.memory_level == "static"
+            or self._init_pending
+        ):
+            # The result is fully covered by the overlay or the noise, kept
+            # as a static texture, or not initialized yet.
+            return
 
-    def _set_final_texture(self, pos):
-        if not self.background:
+        if self.uses_image_levels:
+            self._render_image_levels()
+            self._blur_dirty = False
             return
 
-        if self._last_background_canvas not in self.h_blur.children:
-            self.h_blur.add(self._last_background_canvas)
+        fingerprint = self._get_fingerprint()
+        if not self._force_render:
+            if fingerprint == self._rendered_fingerprint:
+                self.fingerprint_hits += 1
+                self._blur_dirty = False
+                return
+            self.fingerprint_misses += 1
+        self._force_render = False
+        self._rendered_fingerprint = fingerprint
+
+        if self.uses_cpu_blur:
+            self._render_cpu_blur()
+        else:
+            self._render_gpu_blur()
+        self._blur_dirty = False
+
+    def _attach_background(self, fbo):
+        """Makes sure the background canvas is only drawn by ``fbo``."""
+        canvas = self._last_background_canvas
+        for other in (self.h_blur, self.capture):
+            if other is not fbo and canvas in other.children:
+                other.remove(canvas)
+        if canvas not in fbo.children:
+            fbo.add(canvas)
+
+    def _render_gpu_blur(self):
+        self._attach_background(self.h_blur)
+        if self.h_blur.rect not in self.v_blur.children:
             self.v_blur.add(self.h_blur.rect)
 
         if self.h_blur.rect.texture != self.h_blur.texture:
             self.h_blur.rect.texture = self.h_blur.texture
 
-        self.h_blur.rect.size = self.size
-        self.h_blur.rect.pos = self._pos
+        x, y, width, height = self._blur_region
+        self.h_blur.rect.size = (width, height)
+        self.h_blur.rect.pos = (x, y)
 
-        self.h_blur.draw()
+        with profiling.gpu_pass(self, "h_blur", self.h_blur):
+            self.h_blur.draw()
         self.h_blur.ask_update()
-        self.v_blur.draw()
+        with profiling.gpu_pass(self, "v_blur", self.v_blur):
+            self.v_blur.draw()
         self.v_blur.ask_update()
 
         self.bt_1.texture = self.v_blur.texture
 
-        if self._update_texture_ev.timeout == 0:
-            self._update_texture_ev.timeout = -1
+    def _render_cpu_blur(self):
+        self._attach_background(self.capture)
+        with profiling.gpu_pass(self, "capture", self.capture):
+            self.capture.draw()
+        size = tuple(int(v) for v in self.capture.size)
+        # Same extent as the 13 taps of the blur shaders, in pixels.
+        radius = (
+            1.5 * self.h_blur["blur_size"] / MEAN_RES * size[0],
+            1.5 * self.v_blur["blur_size"] / MEAN_RES * size[1],
+        )
+        with profiling.gpu_pass(self, "cpu_blur", self.capture):
+            pixels = _cpu_blur.box_blur(self.capture.pixels, size, radius)
+
+        texture = self._cpu_texture
+        if texture is None or tuple(texture.size) != size:
+            texture = self._cpu_texture = Texture.create(
+                size=size, colorfmt="rgba"
+            )
+            self._account_memory()
+        texture.blit_buffer(pixels, colorfmt="rgba", bufferfmt="ubyte")
+        self.bt_1.texture = texture
+
+    def _render_image_levels(self):
+        """Selects the two pre-blurred levels of the Image background that
+        are closest to the current blur, mixed by the final shader."""
+        levels = _get_image_levels(self.background)
+        height = self._blur_region[3]
+        # Standard deviation of the 13 taps of the blur shaders, in pixels of
+        # the first level. The horizontal pass samples the texture of the
+        # Image, and the vertical one the result of the horizontal pass.
+        blur_size = dp(int(self.blur_size)) * 1.5 / MEAN_RES / math.sqrt(3)
+        sigma = math.sqrt(
+            blur_size * levels[0].width
+            * blur_size * max(1, self.height) * levels[0].height / height
+        )
+        level = min(0.5 * math.log2(sigma ** 2 + 1), len(levels) - 1)
+        lower = int(level)
+        upper = min(lower + 1, len(levels) - 1)
+        self.bt_1.texture = levels[lower]
+        self.bt_3.texture = levels[upper]
+        self.frosted_glass_effect["level_mix"] = float(level - lower)
+
+    @property
+    def uses_cpu_blur(self):
+        if not _cpu_blur.is_available():
+            return False
+        if self.blur_backend == "auto":
+            return _cpu_blur.is_software_renderer()
+        return self.blur_backend == "cpu"
+
+    def on_blur_backend(self, _, backend):
+        if backend == "cpu" and not _cpu_blur.is_available():
+            Logger.warning(
+                "FrostedGlass: NumPy is required by the cpu blur backend, "
+                "the gpu backend is used instead."
+            )
+
+    def _get_fingerprint(self):
+        """Cheap summary of what would be blurred: the widgets drawn in the
+        background tree (computed once per frame) and the blurred region."""
+        return (
+            _get_content_fingerprint(
+                self.background,
+                self.background_children_list,
+                self._background_kinds,
+            ),
+            self._blur_region,
+            tuple(self.h_blur.size),
+            tuple(self.capture.size),
+            self.blur_size,
+        )
 
     def _update_noise_texture(self):
-        fbo_size = max(1, self.width / dp(1)), max(1, self.height / dp(1))
+        if (
+            not self.effect_visible
+            or not self.uses_noise
+            or self._init_pending
+        ):
+            self._noise_dirty = True
+            return
+
+        self._noise_dirty = False
+        if self._memory_level_index >= MEMORY_LEVELS.index("shared_noise"):
+            self.noise.size = (1, 1)
+            self.bt_2.texture = _get_shared_noise_texture()
+            self._account_memory()
+            return
+
+        scale = self._memory_scale
+        fbo_size = (
+            max(1, self.width / dp(1) * scale),
+            max(1, self.height / dp(1) * scale),
+        )
         self.noise.size = fbo_size
         self.noise.rect.size = self.size
         self.noise.add(self.noise.rect)
         self.noise.draw()
         self.noise.remove(self.noise.rect)
         self.bt_2.texture = self.noise.texture
+        self._account_memory()
 
     def _update_fbo_effect(self, *args):
-        if self.is_movable:
-            fbo_size = (min(self.width, 150), min(self.height, 150))
-        else:
-            fbo_size = (min(self.width, 250), min(self.height, 250))
+        if (
+            not self.effect_visible
+            or self.in_transition
+            or not self.uses_blur
+            or self._init_pending
+        ):
+            return
+        self._setup_fbos()
 
+    def _setup_fbos(self):
+        # The variant is only updated with the uniforms, and the background
+        # may have changed since.
+        self._update_shader_variant()
+        if self.memory_level == "static" or not self.uses_blur:
+            return
+        # The content of resized Fbos is lost.
+        self._force_render = True
+        self._pos = self._get_window_pos()
+        x, y, width, height = self._blur_region = self._get_blur_region()
         size = max(1, self.width), max(1, self.height)
-        fbo_size = max(1, fbo_size[0]), max(1, fbo_size[1])
 
-        self.h_blur.size = fbo_size
-        self.v_blur.size = fbo_size
+        # The Fbos are downscaled according to the size of FrostedGlass, the
+        # margin around it (if any) keeps the same resolution. The memory
+        # level scales them down further, whatever their size.
+        max_size = 150 if self.is_movable else 250
+        scale = self._memory_scale
+        fbo_size = (
+            max(1, width * min(1, max_size / size[0]) * scale),
+            max(1, height * min(1, max_size / size[1]) * scale),
+        )
 
-        pos = self.to_window(*self.pos)
-        x = 1 / (size[0] / fbo_size[0])
-        y = 1 / (size[1] / fbo_size[1])
+        # Only the Fbos used by the current backend are allocated.
+        if self.uses_image_levels:
+            self.h_blur.size = self.v_blur.size = (1, 1)
+            self.capture.size = (1, 1)
+            self._cpu_texture = None
+        elif self.uses_cpu_blur:
+            self.h_blur.size = self.v_blur.size = (1, 1)
+            self.capture.size = fbo_size
+        else:
+            self.h_blur.size = self.v_blur.size = fbo_size
+            self.capture.size = (1, 1)
+            self._cpu_texture = None
+
+        self.h_blur_scale.x = self.v_blur_scale.x = fbo_size[0] / width
+        self.h_blur_scale.y = self.v_blur_scale.y = -fbo_size[1] / height
+        self.capture_scale.x = fbo_size[0] / width
+        self.capture_scale.y = fbo_size[1] / height
+        self._set_blur_region(self._blur_region)
+        self._update_blur_size()
+        self._blur_dirty = True
+        self._account_memory()
+
+    @property
+    def _memory_level_index(self):
+        return MEMORY_LEVELS.index(self.memory_level)
+
+    @property
+    def _memory_scale(self):
+        """Scale of the Fbos for the current :attr:`memory_level`."""
+        return 0.5 if self._memory_level_index else 1
+
+    def _account_memory(self):
+        """Reports the GPU memory allocated by the Fbos and textures to
+        :data:`~kivy_garden.frostedglass.memory.gpu_memory`."""
+        usage = {
+            "noise": texture_bytes(self.noise.size),
+            "h_blur": texture_bytes(self.h_blur.size),
+            "v_blur": texture_bytes(self.v_blur.size),
+            "capture": texture_bytes(self.capture.size),
+            "cpu_texture": 0,
+            "static": 0,
+        }
+        if self._cpu_texture is not None:
+            usage["cpu_texture"] = texture_bytes(self._cpu_texture.size)
+        if self.memory_level == "static" and self.bt_1.texture is not None:
+            usage["static"] = texture_bytes(self.bt_1.texture.size)
+        gpu_memory.update(self, usage)
+
+    def _set_memory_level(self, level):
+        """Applies the memory ``level`` (one of
+        :data:`~kivy_garden.frostedglass.memory.MEMORY_LEVELS`). Called by
+        :data:`~kivy_garden.frostedglass.memory.gpu_memory`."""
+        self.memory_level = level
+        if level == "static":
+            # The texture of the last result is kept by bt_1.
+            _dirty_instances.discard(self)
+            for fbo in (self.h_blur, self.v_blur, self.capture):
+                fbo.size = (1, 1)
+            self._cpu_texture = None
+        else:
+            self._update_fbo_effect()
+            self._update_glsl_ev()
+        self._noise_dirty = True
+        self._update_noise_texture()
+        self._account_memory()
 
-        self.h_blur_scale.x = self.v_blur_scale.x = x
-        self.h_blur_scale.y = self.v_blur_scale.y = -y
-        self.h_blur_translate.x = self.v_blur_translate.x = -pos[0]
-        self.h_blur_translate.y = self.v_blur_translate.y = -pos[1] - size[1]
+    def _update_blur_size(self):
+        # The blur is applied in texture coordinates, so it's scaled down
+        # when the blurred region is larger than FrostedGlass.
+        blur_size = dp(int(self.blur_size))
+        width, height = (max(1, v) for v in self._blur_region[2:])
+        self.h_blur["blur_size"] = blur_size * max(1, self.width) / width
+        self.v_blur["blur_size"] = blur_size * max(1, self.height) / height
 
     def on_touch_down(self, touch):
         if self.collide_point(*touch.pos):
@@ -509,12 +1517,23 @@ class FrostedGlass(FloatLayout):
         self._update_canvas()
         self._update_noise_texture()
         self.refresh_effect()
+        self._update_visibility_ev()
+        if self.in_transition:
+            self._capture_transition_ev()
 
     def on_pos(self, *args):
         self._update_canvas()
         self.refresh_effect()
+        self._update_visibility_ev()
+
+    def on_opacity(self, instance, opacity):
+        super().on_opacity(instance, opacity)
+        self._update_visibility_ev()
 
     def _update_canvas(self, *args):
+        if self._batch_depth:
+            self._batch_pending.add("_update_canvas")
+            return
         border_radius = list(
             map(
                 lambda x: max(1, min(min(self.width, self.height) / 2, x)),
@@ -536,64 +1555,275 @@ class FrostedGlass(FloatLayout):
     def on_blur_size(self, instance, blur_size):
         blur_size = int(blur_size)
         if blur_size != self.last_blur_size_value:
-            self.v_blur["blur_size"] = dp(blur_size)
-            self.h_blur["blur_size"] = dp(blur_size)
-            self.update_effect()
+            self._update_blur_size()
+            self._update_effect()
             self.last_blur_size_value = blur_size
 
     def on_background(self, _, background):
+        # Stops using the levels of a previous Image background.
+        self._update_shader_variant()
+        self._unbind_background()
         if not background:
+            self._last_background_canvas = None
             return
 
-        if self._last_background_canvas in self.h_blur.children:
-            self.h_blur.remove(self._last_background_canvas)
-            self.update_effect()
-            self._unbind_parent_properties(self.background_parents_list)
-            self._unbind_children_properties(self.background_children_list)
-
         self._last_background_canvas = background.canvas
+        if not self.effect_visible:
+            return
 
-        self.background_parents_list = self._get_all_parents(self.background)
-        self.background_children_list = self._get_all_children(self.background)
+        self._scan_tree(
+            "background",
+            self._iter_background_tree(background),
+            self._on_background_scanned,
+        )
+
+    def _iter_background_tree(self, background):
+        for widget, kind in _iter_kinds(_iter_parents(background)):
+            yield widget, kind, True
+        for widget, kind in _iter_kinds(_iter_children(background)):
+            yield widget, kind, False
+
+    def _on_background_scanned(self, widgets):
+        self.background_parents_list = [
+            w for w, _, parent in widgets if parent
+        ]
+        self.background_children_list = [
+            w for w, _, parent in widgets if not parent
+        ]
+        self._background_kinds = {w: kind for w, kind, _ in widgets}
+        _invalidate_render_graph()
         self._bind_parent_properties(self.background_parents_list)
         self._bind_children_properties(self.background_children_list)
+        self.update_effect()
+
+    def _unbind_background(self):
+        event = self._tree_scan_events.pop("background", None)
+        if event is not None:
+            event.cancel()
+
+        for fbo in (self.h_blur, self.capture):
+            if self._last_background_canvas in fbo.children:
+                fbo.remove(self._last_background_canvas)
+                self._update_effect()
+        self._unbind_parent_properties(self.background_parents_list)
+        self._unbind_children_properties(self.background_children_list)
+        self.background_parents_list = []
+        self.background_children_list = []
+        self._background_kinds = {}
+        _invalidate_render_graph()
 
     def on_parent(self, _, parent):
         if not parent:
+            self._on_parents_scanned([])
             return
 
-        self.parents_list = self._get_all_parents(parent)
-        for p in self.parents_list:
-            if isinstance(p, ModalView):
+        # The current ancestors stay bound until the new ones are collected,
+        # so their events (e.g. on_pre_enter of a Screen added back by its
+        # ScreenManager) aren't missed meanwhile.
+        self._scan_tree(
+            "parents",
+            _iter_kinds(_iter_parents(parent)),
+            self._on_parents_scanned,
+        )
+
+    def _on_ancestor_parent(self, *args):
+        self.on_parent(self, self.parent)
+
+    def _on_ancestor_changed(self, widget, value=None):
+        self._update_visibility_ev()
+        if self.in_transition:
+            self._update_position_uniform()
+        elif self.scroll_cache_enabled:
+            # _update_glsl decides whether the blurred region can be reused.
+            self._update_glsl_ev()
+        else:
+            self._trigger_update_effect(widget, value)
+
+    def _bind_ancestor_properties(self, parent_kinds):
+        """Binds the properties of the parents of FrostedGlass that affect
+        its position or visibility. These bindings are kept while the effect
+        is hidden, so it can be resumed as soon as it becomes visible."""
+        for widget, kind in parent_kinds.items():
+            if widget is Window:
+                widget.bind(size=self._on_ancestor_changed)
+                continue
+
+            widget.bind(
+                parent=self._on_ancestor_parent,
+                pos=self._on_ancestor_changed,
+                size=self._on_ancestor_changed,
+                opacity=self._on_ancestor_changed,
+            )
+            if kind == "scrollview":
+                widget.bind(
+                    scroll_x=self._on_ancestor_changed,
+                    scroll_y=self._on_ancestor_changed,
+                )
+            elif kind == "modalview":
+                widget.bind(on_pre_open=self._on_ancestor_changed)
+            elif kind == "screen":
+                widget.bind(
+                    on_pre_enter=self._on_screen_pre_enter,
+                    on_enter=self._on_screen_enter,
+                    on_pre_leave=self._on_screen_pre_leave,
+                    on_leave=self._on_screen_leave,
+                )
+
+    def _unbind_ancestors(self):
+        event = self._tree_scan_events.pop("parents", None)
+        if event is not None:
+            event.cancel()
+
+        for widget, kind in self._parent_kinds.items():
+            if widget is Window:
+                widget.unbind(size=self._on_ancestor_changed)
+                continue
+
+            widget.unbind(
+                parent=self._on_ancestor_parent,
+                pos=self._on_ancestor_changed,
+                size=self._on_ancestor_changed,
+                opacity=self._on_ancestor_changed,
+            )
+            if kind == "scrollview":
+                widget.unbind(
+                    scroll_x=self._on_ancestor_changed,
+                    scroll_y=self._on_ancestor_changed,
+                )
+            elif kind == "modalview":
+                widget.unbind(on_pre_open=self._on_ancestor_changed)
+            elif kind == "screen":
+                widget.unbind(
+                    on_pre_enter=self._on_screen_pre_enter,
+                    on_enter=self._on_screen_enter,
+                    on_pre_leave=self._on_screen_pre_leave,
+                    on_leave=self._on_screen_leave,
+                )
+        self.parents_list = []
+        self._parent_kinds = {}
+
+    def _on_parents_scanned(self, parents):
+        self._unbind_ancestors()
+        self.parents_list = parents_list = [w for w, _ in parents]
+        self._parent_kinds = dict(parents)
+        self.popup_parent = None
+        self.parent_screen = None
+        was_movable = self.is_movable
+        self.is_movable = False
+        for p, kind in parents:
+            if kind == "modalview":
                 self.popup_parent = p
-            if isinstance(p, Screen):
+            elif kind == "screen":
                 self.parent_screen = p
-            if isinstance(p, ScrollView):
+            elif kind == "scrollview":
                 self.is_movable = True
-        self._bind_parent_properties(self.parents_list)
-
-    def _get_all_parents(self, widget):
-        widgets_list = []
-        parent = widget
-        while True:
-            widgets_list.append(parent)
-            if parent.parent and parent != parent.parent:
-                parent = parent.parent
-            else:
-                break
-        return widgets_list
-
-    def _get_all_children(self, widget):
-        widgets_list = [widget]
-        children_widgets = [widget]
-        while children_widgets:
-            parent_widgets = children_widgets
-            children_widgets = []
-            for w in parent_widgets:
-                if w.children:
-                    widgets_list.extend(w.children)
-                    children_widgets.extend(w.children)
-        return widgets_list
+        self._bind_ancestor_properties(self._parent_kinds)
+        if self.is_movable != was_movable:
+            # The Fbos are smaller inside a ScrollView.
+            self.refresh_effect()
+
+        self._in_window = bool(parents_list) and parents_list[-1] is Window
+        self._update_visibility()
+        if not self._in_window and not self.effect_visible:
+            # Also when it was already hidden before leaving the window.
+            self._idle_release_ev.cancel()
+            self._release_fbos()
+
+    def _update_visibility(self, *args):
+        self.effect_visible = bool(
+            self._in_window
+            and not self.popup_closed
+            and not self.not_current_screen
+            and (
+                self.in_transition
+                or not (self.out_of_the_window or self.out_of_the_viewport)
+            )
+            and self.effective_opacity > 0
+        )
+
+    def on_effect_visible(self, _, visible):
+        gpu_memory.set_visible(self, visible)
+        _invalidate_render_graph()
+        if visible:
+            _visible_instances.add(self)
+            self._resume_effect()
+            if not self.effect_ready:
+                initializer.schedule(self)
+        else:
+            _visible_instances.discard(self)
+            initializer.cancel(self)
+            self._suspend_effect()
+
+    def _suspend_effect(self):
+        """Stops all the work related to the effect, including the bindings
+        to the background, while FrostedGlass is hidden."""
+        self._unbind_background()
+
+        self._update_glsl_ev.cancel()
+        self._update_fbo_ev.cancel()
+        _dirty_instances.discard(self)
+
+        if not self._in_window:
+            self._capture_transition_ev.cancel()
+            self._transition_screen = None
+            self._release_fbos()
+        elif self.idle_release_timeout >= 0:
+            self._idle_release_ev.timeout = self.idle_release_timeout
+            self._idle_release_ev()
+
+    def _resume_effect(self):
+        self._idle_release_ev.cancel()
+        if self.background:
+            self.on_background(self, self.background)
+        if self._noise_dirty or self._fbos_released:
+            self._update_noise_texture()
+        self._fbos_released = False
+        self.refresh_effect()
+
+    def _release_fbos(self, *args):
+        """Releases the GPU memory held by the Fbos. They are allocated again
+        by :meth:`_resume_effect`."""
+        if self._fbos_released:
+            return
+        self._fbos_released = True
+        # The effect is rendered at the full quality when resumed, unless the
+        # GPU memory budget is exceeded again.
+        self.memory_level = "full"
+        self.bt_1.texture = None
+        self.bt_2.texture = None
+        self._cpu_texture = None
+        for fbo in (self.noise, self.h_blur, self.v_blur, self.capture):
+            fbo.size = (1, 1)
+        self._account_memory()
+
+    def _scan_tree(self, name, widgets, callback):
+        """Collects the items yielded by ``widgets`` and passes them to
+        ``callback``. The collection is spread across frames, spending at most
+        :data:`TREE_SCAN_BUDGET` seconds per frame for the scans of all the
+        instances, so deep trees don't stall the frame in which they were
+        assigned. Small trees are collected immediately, unless the budget of
+        the frame is already spent."""
+        event = self._tree_scan_events.pop(name, None)
+        if event is not None:
+            event.cancel()
+
+        collected = []
+
+        def step(*args):
+            deadline = _get_tree_scan_deadline()
+            for widget in widgets:
+                collected.append(widget)
+                if now() >= deadline:
+                    self._tree_scan_events[name] = Clock.schedule_once(step)
+                    return
+            self._tree_scan_events.pop(name, None)
+            callback(collected)
+
+        step()
+
+    @property
+    def tree_scan_pending(self):
+        return bool(self._tree_scan_events)
 
     def _bind_children_properties(self, children_list):
         properties_to_bind = (
@@ -618,9 +1848,8 @@ class FrostedGlass(FloatLayout):
                                 position=self._trigger_update_effect
                             )
                     elif hasattr(widget, property):
-                        widget.fbind(
-                            property,
-                            self._trigger_update_effect,
+                        widget.bind(
+                            **{property: self._trigger_update_effect}
                         )
                 except Exception as e:
                     print(e)
@@ -641,12 +1870,9 @@ class FrostedGlass(FloatLayout):
                     on_pre_open=self._trigger_update_effect
                 )
             elif isinstance(widget, Screen):
-                widget.bind(
-                    on_pre_enter=lambda *args: self._refresh_effect_ev()
-                )
-                widget.bind(
-                    on_enter=lambda *args: self._refresh_effect_ev.cancel()
-                )
+                # Screen events are only bound for the parents of
+                # FrostedGlass, see _bind_ancestor_properties.
+                pass
 
             else:
                 widget.bind(size=self._trigger_update_effect)
@@ -678,9 +1904,8 @@ class FrostedGlass(FloatLayout):
                                 position=self._trigger_update_effect
                             )
                     elif hasattr(widget, property):
-                        widget.funbind(
-                            property,
-                            self._trigger_update_effect,
+                        widget.unbind(
+                            **{property: self._trigger_update_effect}
                         )
                 except Exception as e:
                     print(e)
@@ -701,12 +1926,7 @@ class FrostedGlass(FloatLayout):
                     on_pre_open=self._trigger_update_effect
                 )
             elif isinstance(widget, Screen):
-                widget.unbind(
-                    on_pre_enter=lambda *args: self._refresh_effect_ev()
-                )
-                widget.unbind(
-                    on_enter=lambda *args: self._refresh_effect_ev.cancel()
-                )
+                pass
 
             else:
                 widget.unbind(size=self._trigger_update_effect)
@@ -715,28 +1935,54 @@ class FrostedGlass(FloatLayout):
                 except Exception:
                     pass
 
-    def _trigger_update_effect(self, widget, value=None):
-        if (
-            isinstance(value, (int, float))
-            and self.update_by_timeout
-            and round(value, 3) != self.last_value
-        ):
-            self.update_effect()
-            self.last_value = round(value, 3)
+    def _on_screen_pre_enter(self, screen):
+        # If the effect isn't ready yet, the placeholder is shown and the
+        # initializer captures the snapshot in its last steps, within its
+        # budget per frame.
+        self._transition_screen = screen
+        self._update_visibility()
+        self._capture_transition_snapshot()
+
+    def _on_screen_pre_leave(self, screen):
+        # The current effect is kept as the snapshot.
+        self._transition_screen = screen
+        self._update_position_uniform()
+
+    def _on_screen_enter(self, *args):
+        self._end_transition()
+
+    def _on_screen_leave(self, *args):
+        self._end_transition()
+
+    def _end_transition(self):
+        self._capture_transition_ev.cancel()
+        self._transition_screen = None
+        self._update_visibility()
+        self.refresh_effect()
 
-        elif (
-            isinstance(value, list)
-            and self.update_by_timeout
-            and (
-                round(value[0], 2) != self.last_value_list[0]
-                or round(value[1], 2) != self.last_value_list[1]
-            )
+    def _capture_transition_snapshot(self, *args):
+        """Renders the effect once, as it will look at the end of the
+        :class:`~kivy.uix.screenmanager.Screen` transition. The result moves
+        with the screen during the transition, without being re-rendered."""
+        if (
+            not self.in_transition
+            or not self.effect_visible
+            or self._init_pending
         ):
-            self.update_effect()
-            self.last_value_list = round(value[0], 2), round(value[1], 2)
+            return
+        if self._noise_dirty:
+            self._update_noise_texture()
+        self._setup_fbos()
+        self._set_final_texture()
 
-        elif self.update_by_timeout:
-            self.update_effect()
+    def _trigger_update_effect(self, widget, *args):
+        if not self.effect_visible:
+            return
+        if not args:
+            # Events (on_open, on_enter, ...) can change the content without
+            # changing any of the properties in the fingerprint.
+            self._force_render = True
+        self._update_effect()
 
     @property
     def popup_closed(self):
@@ -755,15 +2001,21 @@ class FrostedGlass(FloatLayout):
         return right < 0 or top < 0 or x > Window.width or y > Window.height
 
     @property
-    def update_by_timeout(self):
-        _now = now()
-        if _now - self.last_update_time >= 0.016666:
-            self.last_update_time = _now
-            return True
+    def out_of_the_viewport(self):
+        x, y = self.to_window(self.x, self.y)
+        right, top = self.to_window(self.right, self.top)
+        for p in self.parents_list:
+            if not isinstance(p, ScrollView):
+                continue
+            p_x, p_y = p.to_window(p.x, p.y)
+            p_right, p_top = p.to_window(p.right, p.top)
+            if right < p_x or top < p_y or x > p_right or y > p_top:
+                return True
         return False
 
     @property
-    def background_loaded(self):
-        if not self.background:
-            return False
-        return self.background.canvas in self.h_blur.children
+    def effective_opacity(self):
+        opacity = self.opacity
+        for p in self.parents_list:
+            opacity *= getattr(p, "opacity", 1)
+        return opacity
@@ -0,0 +1,76 @@
+"""
+CPU blur backend
+================
+
+Separable box blur computed with NumPy, used instead of the blur shaders
+where they are the main cost of a frame, i.e. on software renderers
+(llvmpipe, SwiftShader, ...). Its cost doesn't depend on the blur size.
+
+NumPy is an optional dependency, installed with
+``pip install kivy_garden.frostedglass[cpu]``.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Substrings of GL_RENDERER that identify a software renderer.
+SOFTWARE_RENDERERS = (
+    "llvmpipe",
+    "softpipe",
+    "swiftshader",
+    "software rasterizer",
+)
+
+_software_renderer = None
+
+
+def is_available():
+    return np is not None
+
+
+def is_software_renderer():
+    """Whether the current OpenGL renderer runs on the CPU. Requires the
+    window (and its GL context) to be created."""
+    global _software_renderer
+    if _software_renderer is None:
+        from kivy.graphics.opengl import GL_RENDERER, glGetString
+
+        renderer = glGetString(GL_RENDERER) or b""
+        if isinstance(renderer, bytes):
+            renderer = renderer.decode("utf-8", "replace")
+        renderer = renderer.lower()
+        _software_renderer = any(
+            name in renderer for name in SOFTWARE_RENDERERS
+        )
+    return _software_renderer
+
+
+def _box_blur_axis(image, radius, axis):
+    if radius < 1:
+        return image
+    size = image.shape[axis]
+    padding = [(0, 0)] * image.ndim
+    padding[axis] = (radius + 1, radius)
+    # The edges are repeated, as the shaders clamp the texture coordinates.
+    summed = np.cumsum(
+        np.pad(image, padding, mode="edge"), axis=axis, dtype=np.float32
+    )
+    upper = [slice(None)] * image.ndim
+    lower = [slice(None)] * image.ndim
+    upper[axis] = slice(2 * radius + 1, 2 * radius + 1 + size)
+    lower[axis] = slice(0, size)
+    return (summed[tuple(upper)] - summed[tuple(lower)]) / (2 * radius + 1)
+
+
+def box_blur(pixels, size, radius):
+    """Blurs the RGBA ``pixels`` (bytes) of an image of ``size`` (width,
+    height), with a horizontal and a vertical box blur of ``radius`` (x, y)
+    pixels. Returns the blurred pixels as bytes."""
+    width, height = size
+    image = np.frombuffer(pixels, dtype=np.uint8).reshape(height, width, 4)
+    radius_x, radius_y = (int(round(r)) for r in radius)
+    image = _box_blur_axis(image, radius_x, 1)
+    image = _box_blur_axis(image, radius_y, 0)
+    return np.clip(image + 0.5, 0, 255).astype(np.uint8).tobytes()
@@ -0,0 +1,169 @@
+"""
+Initialization
+==============
+
+The effect of each FrostedGlass is initialized progressively, once it becomes
+visible: the shader setup, the noise texture, the allocation of the Fbos and
+the first blur are spread across frames, spending at most
+:attr:`Initializer.budget` seconds per frame for all the instances, so a
+screen with many FrostedGlass doesn't stall its first frame. Until it's
+ready (see :attr:`~kivy_garden.frostedglass.FrostedGlass.effect_ready`), each
+instance only draws its ``overlay_color`` over the background, as a flat
+tinted overlay. Instances shown for the first time by a
+:class:`~kivy.uix.screenmanager.Screen` transition keep the placeholder until
+they are ready, and their transition snapshot is captured by the last steps.
+
+Example::
+
+    from kivy_garden.frostedglass.initialization import initializer
+
+    def on_all_ready(initializer):
+        print("All the FrostedGlass are ready")
+
+    initializer.bind(on_all_ready=on_all_ready)
+
+or, from a coroutine (with :meth:`~kivy.app.App.async_run`)::
+
+    await initializer.wait_all_ready()
+"""
+
+__all__ = ("Initializer", "initializer")
+
+import asyncio
+from collections import deque
+from time import perf_counter as now
+from weakref import WeakSet, ref
+
+from kivy.clock import Clock
+from kivy.event import EventDispatcher
+from kivy.properties import NumericProperty
+
+
+class Initializer(EventDispatcher):
+    """Runs the initialization steps of the FrostedGlass instances. Use the
+    :data:`initializer` instance.
+
+    :Events:
+        `on_all_ready`:
+            Fired when all the visible instances are ready, and no
+            instance may still become visible once its tree is scanned.
+    """
+
+    __events__ = ("on_all_ready",)
+
+    budget = NumericProperty(0.004)
+    """Maximum time (in seconds) spent initializing instances per frame. At
+    least one step is run per frame.
+
+    :attr:`budget` is a :class:`~kivy.properties.NumericProperty` and
+    defaults to 0.004."""
+
+    pending = NumericProperty(0)
+    """Number of instances waiting to be initialized.
+
+    :attr:`pending` is a :class:`~kivy.properties.NumericProperty`,
+    read-only, and defaults to 0."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # (weak reference to the instance, iterator of its steps)
+        self._queue = deque()
+        # All the instances, see _settling().
+        self._instances = WeakSet()
+        self._step_ev = Clock.create_trigger(self._step, 0)
+
+    def track(self, instance):
+        """Registers ``instance``. Until its tree scans and its visibility
+        update are done, it isn't known whether it must be initialized."""
+        self._instances.add(instance)
+
+    def schedule(self, instance):
+        """Queues the initialization of ``instance``."""
+        if any(instance_ref() is instance for instance_ref, _ in self._queue):
+            return
+        self._queue.append((ref(instance), instance._iter_init_steps()))
+        self.pending = len(self._queue)
+        self._step_ev()
+
+    def cancel(self, instance):
+        """Removes ``instance`` from the queue. Its initialization starts
+        over when it's scheduled again."""
+        queue = deque(
+            (instance_ref, steps)
+            for instance_ref, steps in self._queue
+            if instance_ref() not in (instance, None)
+        )
+        if len(queue) != len(self._queue):
+            self._queue = queue
+            self.pending = len(queue)
+            self._step_ev()
+
+    async def wait_all_ready(self):
+        """Waits until all the visible instances are ready. Requires an
+        asyncio event loop."""
+        if not self._queue and not self._settling():
+            return
+        self._step_ev()
+        future = asyncio.get_running_loop().create_future()
+
+        def on_all_ready(*args):
+            if not future.done():
+                future.set_result(None)
+
+        uid = self.fbind("on_all_ready", on_all_ready)
+        try:
+            await future
+        finally:
+            self.unbind_uid("on_all_ready", uid)
+
+    def on_all_ready(self):
+        pass
+
+    def _step(self, *args):
+        deadline = now() + self.budget
+        waiting = 0
+        while self._queue and waiting < len(self._queue):
+            instance_ref, steps = self._queue[0]
+            instance = instance_ref()
+            if instance is None:
+                self._queue.popleft()
+                continue
+
+            instance._initializing = True
+            try:
+                wait = next(steps)
+            except StopIteration:
+                self._queue.popleft()
+                wait = False
+            finally:
+                instance._initializing = False
+            if wait:
+                # The instance waits for something else (e.g. the scan of
+                # its background), the next ones are initialized meanwhile.
+                self._queue.rotate(-1)
+                waiting += 1
+            else:
+                waiting = 0
+            if now() >= deadline:
+                break
+
+        self.pending = len(self._queue)
+        if self._queue or self._settling():
+            # The instances being settled may still be queued.
+            self._step_ev()
+        else:
+            self.dispatch("on_all_ready")
+
+    def _settling(self):
+        """Whether an instance may still become visible, once its tree
+        scans or its pending visibility update are done."""
+        return any(
+            instance.tree_scan_pending
+            or instance._update_visibility_ev.is_triggered
+            for instance in self._instances
+        )
+
+
+initializer = Initializer()
+"""The :class:`Initializer` instance that initializes all the FrostedGlass
+instances."""
@@ -0,0 +1,190 @@
+"""
+GPU memory accounting
+=====================
+
+Tracks the GPU memory allocated by the Fbos and textures of every
+FrostedGlass, per instance and per kind (``"noise"``, ``"h_blur"``,
+``"v_blur"``, ``"capture"``, ``"cpu_texture"``, ``"static"`` and the
+``"shared_noise"`` texture), and enforces an optional global budget.
+
+When the allocated memory exceeds :attr:`GPUMemory.budget`, the Fbos of
+hidden instances that haven't been released yet (see
+:attr:`~kivy_garden.frostedglass.FrostedGlass.idle_release_timeout`) are
+released first, then the visible instances are downgraded one step at a time:
+all of them are downgraded to a level, starting from the ones that have been
+visible for the longest time, before any of them is downgraded further, so
+the quality is lowered evenly:
+
+* ``"reduced"`` → Fbos with half the resolution;
+* ``"shared_noise"`` → the noise texture is shared with other instances;
+* ``"static"`` → the last blurred result is kept as a static texture, and the
+  effect is no longer updated when the background changes.
+
+Example::
+
+    from kivy_garden.frostedglass.memory import gpu_memory
+
+    def on_downgrade(manager, instance, level):
+        print(instance, "downgraded to", level)
+
+    gpu_memory.budget = 32 * 2 ** 20
+    gpu_memory.bind(on_downgrade=on_downgrade)
+"""
+
+__all__ = ("GPUMemory", "gpu_memory", "MEMORY_LEVELS")
+
+from time import perf_counter as now
+from weakref import WeakKeyDictionary
+
+from kivy.clock import Clock
+from kivy.event import EventDispatcher
+from kivy.properties import NumericProperty
+
+# Quality levels of FrostedGlass, from the highest to the lowest.
+MEMORY_LEVELS = ("full", "reduced", "shared_noise", "static")
+
+# Bytes per pixel of the RGBA Fbos and textures.
+BYTES_PER_PIXEL = 4
+
+
+def texture_bytes(size):
+    width, height = size
+    return int(width) * int(height) * BYTES_PER_PIXEL
+
+
+class GPUMemory(EventDispatcher):
+    """Accounting of the GPU memory used by FrostedGlass. Use the
+    :data:`gpu_memory` instance.
+
+    :Events:
+        `on_budget_exceeded`: allocated, budget
+            Fired when the allocated memory exceeds the budget, before any
+            instance is released or downgraded.
+        `on_downgrade`: instance, level
+            Fired when an instance is downgraded to ``level`` (one of
+            :data:`MEMORY_LEVELS`), or ``"released"`` when the Fbos of a
+            hidden instance are released.
+    """
+
+    __events__ = ("on_budget_exceeded", "on_downgrade")
+
+    budget = NumericProperty(0)
+    """Maximum GPU memory (in bytes) used by all the FrostedGlass instances.
+    Changing it restores the full quality of all the instances, which are
+    downgraded again if needed. 0 disables the budget.
+
+    :attr:`budget` is a :class:`~kivy.properties.NumericProperty` and
+    defaults to 0."""
+
+    allocated = NumericProperty(0)
+    """GPU memory (in bytes) currently allocated by all the FrostedGlass
+    instances.
+
+    :attr:`allocated` is a :class:`~kivy.properties.NumericProperty`,
+    read-only, and defaults to 0."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._usage = WeakKeyDictionary()
+        self._last_visible = WeakKeyDictionary()
+        self._shared_usage = {}
+        self._enforce_budget_ev = Clock.create_trigger(
+            self._enforce_budget, -1
+        )
+
+    def get_usage(self, instance):
+        """Returns the bytes allocated by ``instance``, per kind."""
+        return dict(self._usage.get(instance, {}))
+
+    def get_usage_by_kind(self):
+        """Returns the bytes allocated by all the instances, per kind."""
+        usage = dict(self._shared_usage)
+        for instance_usage in self._usage.values():
+            for kind, size in instance_usage.items():
+                usage[kind] = usage.get(kind, 0) + size
+        return usage
+
+    def get_instances(self):
+        """Returns the instances that allocate GPU memory."""
+        return [
+            instance
+            for instance, usage in self._usage.items()
+            if any(usage.values())
+        ]
+
+    def update(self, instance, usage):
+        """Records the bytes allocated by ``instance``, per kind."""
+        self._usage[instance] = usage
+        self._update_allocated()
+
+    def update_shared(self, kind, size):
+        """Records the bytes allocated by a resource shared by several
+        instances."""
+        self._shared_usage[kind] = size
+        self._update_allocated()
+
+    def set_visible(self, instance, visible):
+        self._last_visible[instance] = (visible, now())
+
+    def restore(self):
+        """Restores the full quality of all the instances."""
+        for instance in list(self._usage):
+            if instance.memory_level != MEMORY_LEVELS[0]:
+                instance._set_memory_level(MEMORY_LEVELS[0])
+        self._update_allocated()
+
+    def on_budget(self, *args):
+        self.restore()
+
+    def on_budget_exceeded(self, allocated, budget):
+        pass
+
+    def on_downgrade(self, instance, level):
+        pass
+
+    def _update_allocated(self):
+        self.allocated = sum(self.get_usage_by_kind().values())
+        if self.budget and self.allocated > self.budget:
+            self._enforce_budget_ev()
+
+    def _get_downgrade_order(self):
+        """Hidden instances first, from the least recently visible one, then
+        the visible instances, from the one that has been visible for the
+        longest time."""
+        instances = self.get_instances()
+        return sorted(
+            instances,
+            key=lambda instance: self._last_visible.get(instance, (True, 0)),
+        )
+
+    def _enforce_budget(self, *args):
+        if not self.budget or self.allocated <= self.budget:
+            return
+        self.dispatch("on_budget_exceeded", self.allocated, self.budget)
+
+        for instance in self._get_downgrade_order():
+            if instance.effect_visible or instance._fbos_released:
+                continue
+            instance._release_fbos()
+            self.dispatch("on_downgrade", instance, "released")
+            if self.allocated <= self.budget:
+                return
+
+        visible = [
+            instance
+            for instance in self._get_downgrade_order()
+            if instance.effect_visible
+        ]
+        for index, level in enumerate(MEMORY_LEVELS[1:], 1):
+            for instance in visible:
+                if MEMORY_LEVELS.index(instance.memory_level) >= index:
+                    continue
+                instance._set_memory_level(level)
+                self.dispatch("on_downgrade", instance, level)
+                if self.allocated <= self.budget:
+                    return
+
+
+gpu_memory = GPUMemory()
+"""The :class:`GPUMemory` instance that tracks all the FrostedGlass
+instances."""
@@ -0,0 +1,238 @@
+"""
+Profiling
+=========
+
+Optional instrumentation of the rendering passes of every FrostedGlass
+(horizontal and vertical blur, CPU blur and final composition), exported as
+a Chrome trace-event JSON timeline, alongside the frames of the Kivy Clock.
+The file can be opened in ``chrome://tracing`` or
+`Perfetto <https://ui.perfetto.dev>`_.
+
+Kivy's OpenGL bindings don't expose timer queries, so each pass is bracketed
+by ``glFinish``, which waits for the GPU to complete all the previous work.
+This works on any driver, including Mesa software renderers, but
+serializes the CPU and the GPU: only enable it while profiling.
+
+Example::
+
+    from kivy_garden.frostedglass import profiling
+
+    profiling.start()
+    # ... interact with the app ...
+    profiling.stop()
+    profiling.export("frostedglass_trace.json")
+"""
+
+__all__ = ("start", "stop", "is_enabled", "get_events", "export")
+
+import json
+from time import perf_counter as now
+from weakref import WeakKeyDictionary, WeakSet, ref
+
+from kivy.clock import Clock
+from kivy.graphics import Callback
+from kivy.graphics.opengl import glFinish
+
+_enabled = False
+_events = []
+_origin = 0
+_last_frame_time = None
+_tracks = WeakKeyDictionary()
+_pending_passes = WeakKeyDictionary()
+# FrostedGlass instances, and the Callback instructions placed around their
+# final RenderContext while profiling is enabled.
+_instances = WeakSet()
+_final_pass_callbacks = WeakKeyDictionary()
+
+# Track (tid) of the Clock frames, FrostedGlass instances use the next ones.
+_CLOCK_TRACK = 0
+
+
+def is_enabled():
+    return _enabled
+
+
+def start():
+    """Clears the recorded events and starts recording."""
+    global _enabled, _origin, _last_frame_time
+    del _events[:]
+    _tracks.clear()
+    _pending_passes.clear()
+    _origin = now()
+    _last_frame_time = None
+    _enabled = True
+    _events.append(_thread_name(_CLOCK_TRACK, "Clock"))
+    Clock.unschedule(_record_frame)
+    Clock.schedule_interval(_record_frame, 0)
+    for instance in list(_instances):
+        _add_final_pass_callbacks(instance)
+
+
+def stop():
+    global _enabled
+    _enabled = False
+    Clock.unschedule(_record_frame)
+    for instance in list(_final_pass_callbacks.keys()):
+        _remove_final_pass_callbacks(instance)
+
+
+def register(instance):
+    """Registers a FrostedGlass instance, whose final pass is recorded
+    while profiling is enabled."""
+    _instances.add(instance)
+    if _enabled:
+        _add_final_pass_callbacks(instance)
+
+
+def get_events():
+    """Returns the recorded trace events."""
+    return list(_events)
+
+
+def export(filename):
+    """Writes the recorded events to ``filename``, in the Chrome trace-event
+    JSON format."""
+    with open(filename, "w") as fh:
+        json.dump(
+            {"traceEvents": _events, "displayTimeUnit": "ms"}, fh, indent=1
+        )
+
+
+def _timestamp(time):
+    return (time - _origin) * 1e6
+
+
+def _thread_name(tid, name):
+    return {
+        "name": "thread_name",
+        "ph": "M",
+        "pid": 0,
+        "tid": tid,
+        "args": {"name": name},
+    }
+
+
+def _get_track(instance):
+    track = _tracks.get(instance)
+    if track is None:
+        track = _tracks[instance] = len(_tracks) + 1
+        _events.append(
+            _thread_name(
+                track, "{} #{}".format(type(instance).__name__, track)
+            )
+        )
+    return track
+
+
+def _record(instance, name, start, end, args=None):
+    _events.append({
+        "name": name,
+        "cat": "gpu",
+        "ph": "X",
+        "pid": 0,
+        "tid": _get_track(instance),
+        "ts": _timestamp(start),
+        "dur": (end - start) * 1e6,
+        "args": args or {},
+    })
+
+
+def _record_frame(dt):
+    global _last_frame_time
+    time = now()
+    if _last_frame_time is not None:
+        _events.append({
+            "name": "frame",
+            "cat": "clock",
+            "ph": "X",
+            "pid": 0,
+            "tid": _CLOCK_TRACK,
+            "ts": _timestamp(_last_frame_time),
+            "dur": (time - _last_frame_time) * 1e6,
+            "args": {"frame": Clock.frames, "dt": dt},
+        })
+    _last_frame_time = time
+
+
+class _NoPass:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+_no_pass = _NoPass()
+
+
+class _Pass:
+
+    def __init__(self, instance, name, fbo):
+        self.instance = instance
+        self.name = name
+        self.fbo = fbo
+
+    def __enter__(self):
+        glFinish()
+        self.start = now()
+
+    def __exit__(self, *args):
+        glFinish()
+        _record(
+            self.instance, self.name, self.start, now(),
+            {"fbo_size": list(self.fbo.size)},
+        )
+
+
+def gpu_pass(instance, name, fbo):
+    """Context manager that records the time spent by the GPU drawing the
+    pass ``name`` of ``instance`` into ``fbo``, while profiling is enabled.
+    """
+    if not _enabled:
+        return _no_pass
+    return _Pass(instance, name, fbo)
+
+
+def _add_final_pass_callbacks(instance):
+    """Places Callback instructions before and after the final
+    RenderContext of ``instance``. They are only in its canvas while
+    profiling is enabled, so they cost nothing otherwise."""
+    if instance in _final_pass_callbacks:
+        return
+    canvas = instance.canvas
+    begin, end = _final_pass_callbacks[instance] = final_pass_callbacks(
+        instance
+    )
+    index = canvas.indexof(instance.frosted_glass_effect)
+    canvas.insert(index + 1, end)
+    canvas.insert(index, begin)
+
+
+def _remove_final_pass_callbacks(instance):
+    for callback in _final_pass_callbacks.pop(instance, ()):
+        instance.canvas.remove(callback)
+
+
+def final_pass_callbacks(instance):
+    """Returns the two :class:`~kivy.graphics.Callback` instructions that
+    must be placed before and after the final RenderContext of ``instance``,
+    to record the time spent drawing it."""
+    instance_ref = ref(instance)
+
+    def begin(*args):
+        instance = instance_ref()
+        if _enabled and instance is not None:
+            glFinish()
+            _pending_passes[instance] = now()
+
+    def end(*args):
+        if not _enabled:
+            return
+        instance = instance_ref()
+        start = _pending_passes.pop(instance, None) if instance else None
+        if start is not None:
+            glFinish()
+            _record(instance, "final", start, now())
+
+    return Callback(begin), Callback(end)
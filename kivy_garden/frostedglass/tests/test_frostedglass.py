@@ -0,0 +1,1115 @@
+import pytest
+
+
+def tick(frames=1):
+    from kivy.clock import Clock
+    for _ in range(frames):
+        Clock.tick()
+        Clock.tick_draw()
+
+
+def tick_until_ready(*glasses):
+    """Ticks until the effect of ``glasses`` is initialized, which takes a
+    variable number of frames (see the initialization module), then a few
+    more frames."""
+    for _ in range(100):
+        if all(fg.effect_ready for fg in glasses):
+            break
+        tick()
+    tick(3)
+
+
+@pytest.fixture
+def renders(monkeypatch):
+    """Returns a function that wraps ``method`` of FrostedGlass (the final
+    render by default) and returns the list in which ``value(instance)`` is
+    recorded on each call."""
+    from kivy_garden.frostedglass import FrostedGlass
+
+    def record(value=lambda fg: fg, method="_set_final_texture"):
+        recorded = []
+        wrapped = getattr(FrostedGlass, method)
+
+        def wrapper(self, *args):
+            recorded.append(value(self))
+            return wrapped(self, *args)
+
+        monkeypatch.setattr(FrostedGlass, method, wrapper)
+        return recorded
+
+    return record
+
+
+def test_background_tree_scan_spread_across_frames(monkeypatch):
+    import kivy_garden.frostedglass as frostedglass
+    from kivy.core.window import Window
+    from kivy.uix.widget import Widget
+
+    background = Widget()
+    for _ in range(50):
+        background.add_widget(Widget())
+
+    fg = frostedglass.FrostedGlass()
+    Window.add_widget(fg)
+    try:
+        monkeypatch.setattr(frostedglass, "TREE_SCAN_BUDGET", 0)
+        fg.background = background
+        assert fg.tree_scan_pending
+        assert fg.background_children_list == []
+
+        for _ in range(100):
+            if not fg.tree_scan_pending:
+                break
+            tick()
+        assert not fg.tree_scan_pending
+        assert len(fg.background_children_list) == 51
+        assert fg.background_parents_list == [background]
+    finally:
+        Window.remove_widget(fg)
+
+
+def test_tree_scans_share_the_frame_budget(monkeypatch):
+    import kivy_garden.frostedglass as frostedglass
+    from kivy.clock import Clock
+    from kivy.core.window import Window
+    from kivy.uix.widget import Widget
+
+    background = Widget()
+    for _ in range(60):
+        background.add_widget(Widget())
+    glasses = [frostedglass.FrostedGlass() for _ in range(3)]
+    for fg in glasses:
+        Window.add_widget(fg)
+    tick()
+
+    # Each call to now() takes 1 ms, and each widget is classified by the
+    # walk that collects it.
+    time = [0]
+
+    def fake_now():
+        time[0] += 0.001
+        return time[0]
+
+    classified = {}
+    widget_kind = frostedglass._widget_kind
+
+    def _widget_kind(widget):
+        classified[Clock.frames] = classified.get(Clock.frames, 0) + 1
+        return widget_kind(widget)
+
+    monkeypatch.setattr(frostedglass, "now", fake_now)
+    monkeypatch.setattr(frostedglass, "_tree_scan_start", (None, 0))
+    monkeypatch.setattr(frostedglass, "TREE_SCAN_BUDGET", 0.01)
+    monkeypatch.setattr(frostedglass, "_widget_kind", _widget_kind)
+    try:
+        for fg in glasses:
+            fg.background = background
+        for _ in range(100):
+            if not any(fg.tree_scan_pending for fg in glasses):
+                break
+            tick()
+        assert not any(fg.tree_scan_pending for fg in glasses)
+        for fg in glasses:
+            assert len(fg.background_children_list) == 61
+            assert fg._background_kinds[background] is None
+
+        # The budget is shared by the scans of all the instances, which
+        # collect at least one widget per frame.
+        assert max(classified.values()) <= 10 + len(glasses)
+    finally:
+        for fg in glasses:
+            Window.remove_widget(fg)
+
+
+def test_ancestors_stay_bound_while_scanned_again(monkeypatch):
+    import kivy_garden.frostedglass as frostedglass
+    from kivy.core.window import Window
+    from kivy.uix.screenmanager import Screen, ScreenManager
+
+    manager = ScreenManager()
+    screen = Screen(name="screen")
+    fg = frostedglass.FrostedGlass()
+    screen.add_widget(fg)
+    manager.add_widget(screen)
+    Window.add_widget(manager)
+    try:
+        tick()
+        monkeypatch.setattr(frostedglass, "TREE_SCAN_BUDGET", 0)
+        # As done by the transitions, before on_pre_enter is dispatched.
+        manager.real_remove_widget(screen)
+        manager.real_add_widget(screen)
+        assert fg.tree_scan_pending
+        screen.dispatch("on_pre_enter")
+        assert fg.in_transition
+        screen.dispatch("on_enter")
+        assert not fg.in_transition
+
+        for _ in range(100):
+            if not fg.tree_scan_pending:
+                break
+            tick()
+        assert fg.parents_list == [screen, manager, Window]
+    finally:
+        Window.remove_widget(manager)
+
+
+def test_removing_background_unbinds_it(monkeypatch):
+    import kivy_garden.frostedglass as frostedglass
+    from kivy.core.window import Window
+    from kivy.uix.widget import Widget
+
+    background = Widget()
+    child = Widget()
+    background.add_widget(child)
+    fg = frostedglass.FrostedGlass(blur_backend="gpu")
+    fg.background = background
+    Window.add_widget(background)
+    Window.add_widget(fg)
+    try:
+        tick_until_ready(fg)
+        assert background.canvas in fg.h_blur.children
+        fg.background = None
+        assert background.canvas not in fg.h_blur.children
+        assert fg.background_children_list == []
+        assert fg.background_parents_list == []
+        # Its widgets are no longer bound.
+        fg._update_glsl_ev.cancel()
+        child.pos = (10, 10)
+        assert not fg._update_glsl_ev.is_triggered
+
+        # A pending scan of the background is dropped.
+        monkeypatch.setattr(frostedglass, "TREE_SCAN_BUDGET", 0)
+        fg.background = background
+        assert fg.tree_scan_pending
+        fg.background = None
+        assert not fg.tree_scan_pending
+        tick(3)
+        assert fg.background_children_list == []
+    finally:
+        Window.remove_widget(fg)
+        Window.remove_widget(background)
+
+
+def test_no_leak_when_creating_and_destroying_instances():
+    import gc
+    import os
+    import weakref
+    from kivy.base import EventLoop
+    from kivy.core.window import Window
+    from kivy.uix.screenmanager import Screen, ScreenManager
+    from kivy.uix.widget import Widget
+    from kivy_garden.frostedglass import FrostedGlass
+
+    EventLoop.ensure_window()
+    instances = int(os.environ.get("FG_LEAK_CHECK_INSTANCES", 200))
+
+    manager = ScreenManager()
+    screen = Screen(name="screen")
+    manager.add_widget(screen)
+    background = Widget()
+    screen.add_widget(background)
+    Window.add_widget(manager)
+
+    def observers():
+        return (
+            len(background.get_property_observers("pos"))
+            + len(screen.get_property_observers("size"))
+        )
+
+    try:
+        refs = []
+        expected_observers = observers()
+        for _ in range(instances):
+            fg = FrostedGlass()
+            fg.background = background
+            screen.add_widget(fg)
+            tick()
+            screen.remove_widget(fg)
+            assert tuple(fg.v_blur.size) == (1, 1)
+            refs.append(weakref.ref(fg))
+            del fg
+        tick()
+        gc.collect()
+
+        assert not [ref for ref in refs if ref() is not None]
+        assert observers() == expected_observers
+    finally:
+        Window.remove_widget(manager)
+
+
+def test_hidden_instances_are_suspended():
+    from kivy.core.window import Window
+    from kivy.uix.boxlayout import BoxLayout
+    from kivy.uix.floatlayout import FloatLayout
+    from kivy.uix.scrollview import ScrollView
+    from kivy.uix.widget import Widget
+    from kivy_garden.frostedglass import FrostedGlass
+
+    root = FloatLayout()
+    background = Widget()
+    root.add_widget(background)
+    scroll_view = ScrollView(size_hint=(None, None), size=(200, 200))
+    content = BoxLayout(orientation="vertical", size_hint=(1, None))
+    content.height = 2000
+    scroll_view.add_widget(content)
+    root.add_widget(scroll_view)
+
+    fg = FrostedGlass(size_hint_y=None, height=100)
+    fg.idle_release_timeout = 0
+    content.add_widget(fg)
+    content.add_widget(Widget())
+    fg.blur_backend = "gpu"
+    fg.background = background
+    Window.add_widget(root)
+    try:
+        tick(3)
+        scroll_view.scroll_y = 1
+        tick(3)
+        assert fg.effect_visible
+        assert fg.background_children_list == [background]
+        assert tuple(fg.v_blur.size) != (1, 1)
+
+        scroll_view.scroll_y = 0
+        tick(3)
+        assert not fg.effect_visible
+        assert fg.background_children_list == []
+        assert tuple(fg.v_blur.size) == (1, 1)
+
+        scroll_view.scroll_y = 1
+        tick(3)
+        assert fg.effect_visible
+        assert fg.background_children_list == [background]
+        assert tuple(fg.v_blur.size) != (1, 1)
+
+        # The canvas still follows the opacity, e.g. for fade animations.
+        fg.opacity = 0.5
+        tick(3)
+        assert fg.effect_visible
+        assert fg.canvas.opacity == 0.5
+
+        root.opacity = 0
+        tick(3)
+        assert not fg.effect_visible
+    finally:
+        Window.remove_widget(root)
+
+
+def test_scroll_reuses_blurred_region(renders):
+    from kivy.core.window import Window
+    from kivy.uix.boxlayout import BoxLayout
+    from kivy.uix.floatlayout import FloatLayout
+    from kivy.uix.scrollview import ScrollView
+    from kivy.uix.widget import Widget
+    from kivy_garden.frostedglass import FrostedGlass
+
+    root = FloatLayout()
+    background = Widget()
+    root.add_widget(background)
+    scroll_view = ScrollView(size_hint=(None, None), size=(400, 400))
+    content = BoxLayout(orientation="vertical", size_hint=(1, None))
+    content.height = 4000
+    scroll_view.add_widget(content)
+    root.add_widget(scroll_view)
+
+    renders = renders(lambda fg: fg._blur_region)
+
+    fg = FrostedGlass(size_hint_y=None, height=100)
+    content.add_widget(Widget())
+    content.add_widget(fg)
+    content.add_widget(Widget())
+    fg.background = background
+    Window.add_widget(root)
+    try:
+        scroll_view.scroll_y = 0.5
+        tick_until_ready(fg)
+        assert fg.effect_visible
+        assert fg.scroll_cache_enabled
+        renders.clear()
+
+        scroll_view.scroll_y = 0.5 + 1 / 3600
+        tick(3)
+        assert renders == []
+
+        scroll_view.scroll_y = 0.5 + 120 / 3600
+        tick(3)
+        assert len(renders) == 1
+
+        renders.clear()
+        fg.scroll_margin = 0
+        tick(3)
+        assert not fg.scroll_cache_enabled
+        scroll_view.scroll_y = 0.5
+        tick(3)
+        assert renders
+    finally:
+        Window.remove_widget(root)
+
+
+def test_screen_transition_uses_snapshot(monkeypatch, renders):
+    import time
+    import kivy_garden.frostedglass as frostedglass
+    from kivy.core.window import Window
+    from kivy.uix.screenmanager import Screen, ScreenManager, SlideTransition
+    from kivy.uix.widget import Widget
+    from kivy_garden.frostedglass import FrostedGlass
+
+    renders = renders(lambda fg: fg.in_transition)
+
+    manager = ScreenManager(transition=SlideTransition(duration=0.5))
+    manager.add_widget(Screen(name="first"))
+    screen = Screen(name="second")
+    background = Widget(size_hint=(None, None))
+    screen.add_widget(background)
+    fg = FrostedGlass(size_hint=(None, None))
+    fg.size = (200, 200)
+    fg.background = background
+    screen.add_widget(fg)
+    manager.add_widget(screen)
+    Window.add_widget(manager)
+    try:
+        tick(3)
+        assert not fg.effect_ready
+        monkeypatch.setattr(frostedglass, "TREE_SCAN_BUDGET", 0)
+        manager.current = "second"
+        # Shown for the first time: the placeholder is kept, and the
+        # snapshot is captured by the initializer, within its budget.
+        assert not fg.effect_ready
+        assert renders == []
+        positions = set()
+        while manager.transition.is_active:
+            time.sleep(0.01)
+            tick()
+            if fg.in_transition and fg.effect_ready:
+                positions.add(
+                    tuple(fg.frosted_glass_effect["position"] or ())
+                )
+        tick(3)
+
+        assert fg.background_children_list == [background]
+        assert renders.count(True) == 1
+        assert renders[-1] is False
+        assert len(positions) > 1
+        assert not fg.in_transition
+        assert fg.effect_visible
+    finally:
+        Window.remove_widget(manager)
+
+
+def test_shader_variant_skips_unused_stages(renders):
+    from kivy.core.window import Window
+    from kivy.uix.widget import Widget
+    from kivy_garden.frostedglass import FrostedGlass
+    from kivy_garden.frostedglass.memory import gpu_memory
+
+    renders = renders(lambda fg: fg.uses_blur)
+
+    fg = FrostedGlass(size_hint=(None, None))
+    other = FrostedGlass()
+    fg.size = (200, 200)
+    fg.background = Widget()
+    Window.add_widget(fg)
+    Window.add_widget(other)
+    try:
+        tick(3)
+        effect = fg.frosted_glass_effect
+        assert fg.uses_blur and fg.uses_noise
+        assert fg.bt_1 in effect.children and fg.bt_2 in effect.children
+        assert effect.shader.fs == other.frosted_glass_effect.shader.fs
+
+        fg.noise_opacity = 0
+        tick(3)
+        assert not fg.uses_noise
+        assert fg.bt_2 not in effect.children
+        assert tuple(fg.noise.size) == (1, 1)
+        assert effect.shader.success
+
+        del renders[:]
+        fg.overlay_color = (1, 0, 0, 1)
+        fg.blur_size = 40
+        tick(3)
+        assert fg._shader_variant == ("USE_OVERLAY",)
+        assert fg.bt_1 not in effect.children
+        assert True not in renders
+        assert effect.shader.success
+        # The blur Fbos are shrunk too.
+        for fbo in (fg.h_blur, fg.v_blur, fg.capture):
+            assert tuple(fbo.size) == (1, 1)
+        usage = gpu_memory.get_usage(fg)
+        assert usage["h_blur"] == usage["v_blur"] == 4
+
+        fg.overlay_color = (1, 0, 0, 0.5)
+        fg.noise_opacity = 0.1
+        tick(3)
+        assert fg.uses_blur and fg.uses_noise
+        assert fg.bt_1 in effect.children and fg.bt_2 in effect.children
+        assert renders[-1] is True
+        assert tuple(fg.noise.size) != (1, 1)
+        assert any(
+            tuple(fbo.size) != (1, 1) for fbo in (fg.v_blur, fg.capture)
+        )
+    finally:
+        Window.remove_widget(fg)
+        Window.remove_widget(other)
+
+
+def test_nested_instances_rendered_in_dependency_order(monkeypatch, renders):
+    import kivy_garden.frostedglass as frostedglass
+    from kivy.core.window import Window
+    from kivy.logger import Logger
+    from kivy.uix.floatlayout import FloatLayout
+    from kivy.uix.widget import Widget
+    from kivy_garden.frostedglass import FrostedGlass
+
+    renders = renders()
+    sorts = []
+    get_render_order = frostedglass._get_render_order
+
+    def _get_render_order(instances):
+        sorts.append(instances)
+        return get_render_order(instances)
+
+    monkeypatch.setattr(frostedglass, "_get_render_order", _get_render_order)
+
+    root = FloatLayout()
+    background = Widget(size_hint=(None, None))
+    inner = FrostedGlass(size_hint=(None, None))
+    inner.size = (200, 200)
+    inner.background = background
+    container = FloatLayout()
+    container.add_widget(background)
+    container.add_widget(inner)
+    outer = FrostedGlass(size_hint=(None, None))
+    outer.size = (100, 100)
+    outer.background = container
+    root.add_widget(container)
+    root.add_widget(outer)
+    Window.add_widget(root)
+    try:
+        tick_until_ready(inner, outer)
+        del renders[:]
+        # Only the inner glass is updated by its background, the outer one is
+        # rendered after it, in the same frame.
+        inner.overlay_color = (1, 0, 0, 0.5)
+        tick()
+        assert renders == [inner, outer]
+        # Only the outer glass is rendered, and the order is reused.
+        del renders[:], sorts[:]
+        outer.update_effect()
+        tick()
+        assert renders == [outer]
+        assert sorts == []
+
+        # Cycles are reported and each instance is still rendered once.
+        warnings = []
+        monkeypatch.setattr(
+            Logger, "warning", lambda msg, *args: warnings.append(msg)
+        )
+        inner.background = outer
+        tick(3)
+        # Sorted again once the new background tree is scanned.
+        assert sorts
+        del renders[:]
+        inner.update_effect()
+        outer.update_effect()
+        tick()
+        assert sorted(map(id, renders)) == sorted(map(id, (inner, outer)))
+        assert len(warnings) == 1
+    finally:
+        Window.remove_widget(root)
+
+
+def test_batch_collapses_updates(monkeypatch):
+    from kivy_garden.frostedglass import FrostedGlass
+
+    calls = []
+    for name in ("_update_canvas", "_update_effect"):
+        method = getattr(FrostedGlass, name)
+
+        def counted(self, *args, name=name, method=method):
+            if not self._batch_depth:
+                calls.append(name)
+            method(self, *args)
+
+        counted.__name__ = name
+        monkeypatch.setattr(FrostedGlass, name, counted)
+
+    instances = [FrostedGlass() for _ in range(3)]
+    fg = instances[0]
+    with fg.batch():
+        fg.outline_width = 2
+        with fg.batch():
+            fg.outline_color = (1, 0, 0, 1)
+            fg.border_radius = (10, 10, 10, 10)
+        fg.luminosity = 1.1
+        fg.saturation = 0.9
+        assert calls == []
+    assert sorted(calls) == ["_update_canvas", "_update_effect"]
+    assert list(fg.border_radius) == [10, 10, 10, 10]
+
+    del calls[:]
+    FrostedGlass.apply_theme(
+        instances, overlay_color=(0, 0, 0, 0.3), noise_opacity=0.2,
+        border_radius=(5, 5, 5, 5),
+    )
+    assert calls.count("_update_canvas") == 3
+    assert calls.count("_update_effect") == 3
+    for instance in instances:
+        assert instance.noise_opacity == 0.2
+        assert list(instance.overlay_color) == [0, 0, 0, 0.3]
+
+
+def test_fingerprint_skips_unchanged_content():
+    from kivy.core.window import Window
+    from kivy.graphics import Rectangle
+    from kivy.uix.widget import Widget
+    from kivy_garden.frostedglass import FrostedGlass
+
+    background = Widget()
+    transparent = Widget()
+    drawn = Widget()
+    with drawn.canvas:
+        Rectangle()
+    background.add_widget(transparent)
+    background.add_widget(drawn)
+    fg = FrostedGlass(size_hint=(None, None))
+    fg.size = (200, 200)
+    fg.background = background
+    Window.add_widget(background)
+    Window.add_widget(fg)
+    try:
+        tick(3)
+        rendered = fg._rendered_fingerprint
+        hits = fg.fingerprint_hits
+
+        # Widgets that don't draw anything and parameters of the final shader
+        # don't require a new blur.
+        transparent.pos = (30, 30)
+        tick()
+        fg.luminosity = 1.1
+        tick()
+        assert fg.fingerprint_hits == hits + 2
+        assert fg.fingerprint_misses == 0
+        assert fg._rendered_fingerprint is rendered
+
+        drawn.pos = (30, 30)
+        tick()
+        assert fg.fingerprint_misses == 1
+        assert fg._rendered_fingerprint is not rendered
+
+        # Forced refreshes bypass the fingerprint.
+        rendered = fg._rendered_fingerprint
+        fg.refresh_effect()
+        tick()
+        assert fg.fingerprint_hits == hits + 2
+        assert fg.fingerprint_misses == 1
+        assert fg._rendered_fingerprint is not rendered
+    finally:
+        Window.remove_widget(fg)
+        Window.remove_widget(background)
+
+
+def test_fingerprint_content_shared_by_background(monkeypatch):
+    import kivy_garden.frostedglass as frostedglass
+    from kivy.clock import Clock
+    from kivy.core.window import Window
+    from kivy.graphics import Rectangle
+    from kivy.uix.widget import Widget
+
+    background = Widget()
+    drawn = Widget()
+    with drawn.canvas:
+        Rectangle()
+    background.add_widget(drawn)
+    glasses = [
+        frostedglass.FrostedGlass(
+            size_hint=(None, None),
+            size=(100, 100),
+            pos=(i * 110, 0),
+            background=background,
+        )
+        for i in range(3)
+    ]
+    Window.add_widget(background)
+    for fg in glasses:
+        Window.add_widget(fg)
+
+    walked = {}
+    widget_fingerprint = frostedglass._widget_fingerprint
+
+    def _widget_fingerprint(widget, kind):
+        walked[Clock.frames] = walked.get(Clock.frames, 0) + 1
+        return widget_fingerprint(widget, kind)
+
+    try:
+        tick_until_ready(*glasses)
+        monkeypatch.setattr(
+            frostedglass, "_widget_fingerprint", _widget_fingerprint
+        )
+        misses = [fg.fingerprint_misses for fg in glasses]
+        drawn.pos = (30, 30)
+        tick()
+        assert [fg.fingerprint_misses for fg in glasses] == [
+            n + 1 for n in misses
+        ]
+        # The background tree is walked once per frame, for all the
+        # instances.
+        assert walked
+        assert max(walked.values()) == 2
+    finally:
+        for fg in glasses:
+            Window.remove_widget(fg)
+        Window.remove_widget(background)
+
+
+def test_update_effect_forces_a_new_blur():
+    from kivy.core.window import Window
+    from kivy.graphics import Color, Rectangle
+    from kivy.uix.widget import Widget
+    from kivy_garden.frostedglass import FrostedGlass
+
+    background = Widget(size_hint=(None, None), size=(200, 200))
+    with background.canvas:
+        color = Color(1, 0, 0, 1)
+        Rectangle(size=(200, 200))
+    fg = FrostedGlass(size_hint=(None, None), blur_backend="gpu")
+    fg.size = (100, 100)
+    fg.pos = (50, 50)
+    fg.background = background
+    Window.add_widget(background)
+    Window.add_widget(fg)
+
+    def center_pixel():
+        width, height = (int(v) for v in fg.v_blur.size)
+        index = ((height // 2) * width + width // 2) * 4
+        return tuple(fg.v_blur.pixels[index:index + 3])
+
+    try:
+        tick(3)
+        red, _, blue = center_pixel()
+        assert red > 200 and blue < 50
+
+        # The fingerprint can't see a change of a canvas instruction that
+        # keeps the position and size of the widget.
+        color.rgba = (0, 0, 1, 1)
+        tick(3)
+        red, _, blue = center_pixel()
+        assert red > 200 and blue < 50
+
+        fg.update_effect()
+        tick(3)
+        red, _, blue = center_pixel()
+        assert red < 50 and blue > 200
+    finally:
+        Window.remove_widget(fg)
+        Window.remove_widget(background)
+
+
+def test_cpu_box_blur_matches_reference():
+    np = pytest.importorskip("numpy")
+    from kivy_garden.frostedglass._cpu_blur import box_blur
+
+    width, height = 9, 7
+    image = np.random.RandomState(0).randint(
+        0, 256, (height, width, 4), dtype=np.uint8
+    )
+    blurred = np.frombuffer(
+        box_blur(image.tobytes(), (width, height), (2, 1)), dtype=np.uint8
+    ).reshape(height, width, 4)
+
+    def clamp(value, size):
+        return min(max(value, 0), size - 1)
+
+    horizontal = np.zeros(image.shape)
+    for x in range(width):
+        for dx in range(-2, 3):
+            horizontal[:, x] += image[:, clamp(x + dx, width)] / 5
+    expected = np.zeros(image.shape)
+    for y in range(height):
+        for dy in range(-1, 2):
+            expected[y] += horizontal[clamp(y + dy, height)] / 3
+
+    assert np.abs(blurred - expected).max() <= 1
+
+
+def test_cpu_blur_backend():
+    pytest.importorskip("numpy")
+    from kivy.core.window import Window
+    from kivy.uix.widget import Widget
+    from kivy_garden.frostedglass import FrostedGlass
+
+    fg = FrostedGlass(size_hint=(None, None))
+    fg.size = (200, 200)
+    fg.blur_backend = "cpu"
+    fg.background = Widget()
+    Window.add_widget(fg)
+    try:
+        tick(3)
+        assert fg.uses_cpu_blur
+        assert fg.bt_1.texture is fg._cpu_texture
+        assert tuple(fg._cpu_texture.size) == tuple(fg.capture.size)
+        assert tuple(fg.v_blur.size) == (1, 1)
+
+        fg.blur_backend = "gpu"
+        tick(3)
+        assert not fg.uses_cpu_blur
+        assert fg.bt_1.texture is fg.v_blur.texture
+        assert tuple(fg.capture.size) == (1, 1)
+        assert fg._cpu_texture is None
+    finally:
+        Window.remove_widget(fg)
+
+
+def test_profiling_exports_trace(tmp_path):
+    import json
+    from kivy.base import EventLoop
+    from kivy.core.window import Window
+    from kivy.graphics import Callback
+    from kivy.uix.widget import Widget
+    from kivy_garden.frostedglass import FrostedGlass, profiling
+
+    fg = FrostedGlass(size_hint=(None, None))
+    fg.size = (200, 200)
+    fg.blur_backend = "gpu"
+    fg.background = Widget()
+    Window.add_widget(fg)
+
+    def callbacks():
+        return [
+            instruction for instruction in fg.canvas.children
+            if isinstance(instruction, Callback)
+        ]
+
+    try:
+        # The final pass is only bracketed while profiling.
+        assert callbacks() == []
+        profiling.start()
+        # Starting again doesn't record the frames twice.
+        profiling.start()
+        children = fg.canvas.children
+        index = children.index(fg.frosted_glass_effect)
+        assert children[index - 1:index + 2:2] == callbacks()
+        for _ in range(5):
+            EventLoop.idle()
+        profiling.stop()
+        assert callbacks() == []
+        recorded = len(profiling.get_events())
+        EventLoop.idle()
+        assert len(profiling.get_events()) == recorded
+        frames = [
+            event["args"]["frame"] for event in profiling.get_events()
+            if event["name"] == "frame"
+        ]
+        assert len(frames) == len(set(frames))
+
+        filename = str(tmp_path / "trace.json")
+        profiling.export(filename)
+        with open(filename) as fh:
+            events = json.load(fh)["traceEvents"]
+    finally:
+        Window.remove_widget(fg)
+
+    names = {event["name"] for event in events if event["ph"] == "X"}
+    assert {"frame", "h_blur", "v_blur", "final"} <= names
+    for event in events:
+        if event["ph"] == "X":
+            assert event["dur"] >= 0
+            assert event["ts"] >= 0
+
+
+def test_reduced_memory_level_halves_small_fbos():
+    from kivy.core.window import Window
+    from kivy.uix.widget import Widget
+    from kivy_garden.frostedglass import FrostedGlass
+
+    background = Widget()
+    # Smaller than the maximum size of the Fbos even at the "reduced" level.
+    fg = FrostedGlass(
+        size_hint=(None, None),
+        size=(100, 100),
+        background=background,
+        blur_backend="gpu",
+    )
+    Window.add_widget(background)
+    Window.add_widget(fg)
+    try:
+        tick_until_ready(fg)
+        assert tuple(fg.h_blur.size) == (100, 100)
+        fg._set_memory_level("reduced")
+        tick()
+        assert tuple(fg.h_blur.size) == tuple(fg.v_blur.size) == (50, 50)
+    finally:
+        Window.remove_widget(fg)
+        Window.remove_widget(background)
+
+
+def test_memory_budget_downgrades_least_recently_visible():
+    from kivy.core.window import Window
+    from kivy.uix.widget import Widget
+    from kivy_garden.frostedglass import FrostedGlass
+    from kivy_garden.frostedglass.memory import gpu_memory
+
+    background = Widget()
+    glasses = []
+    for i in range(3):
+        fg = FrostedGlass(size_hint=(None, None))
+        fg.size = (200, 200)
+        fg.pos = (i * 210, 0)
+        fg.blur_backend = "gpu"
+        fg.background = background
+        glasses.append(fg)
+    # Hidden after being rendered, but keeps its Fbos.
+    hidden = FrostedGlass(size_hint=(None, None))
+    hidden.size = (200, 200)
+    hidden.pos = (0, 300)
+    hidden.blur_backend = "gpu"
+    hidden.background = background
+    hidden.idle_release_timeout = -1
+
+    events = []
+    exceeded_uid = gpu_memory.fbind(
+        "on_budget_exceeded", lambda *args: events.append(args)
+    )
+    downgrade_uid = gpu_memory.fbind(
+        "on_downgrade", lambda _, fg, level: events.append((fg, level))
+    )
+    Window.add_widget(background)
+    for fg in glasses + [hidden]:
+        Window.add_widget(fg)
+    try:
+        tick_until_ready(*glasses, hidden)
+        hidden.opacity = 0
+        # The first instance becomes visible after the others.
+        glasses[0].opacity = 0
+        tick()
+        glasses[0].opacity = 1
+        tick(3)
+        usage = gpu_memory.get_usage(glasses[1])
+        assert usage["h_blur"] == usage["v_blur"] == 200 * 200 * 4
+        assert gpu_memory.allocated == sum(
+            gpu_memory.get_usage_by_kind().values()
+        )
+
+        # Releasing the hidden instance is enough.
+        gpu_memory.budget = gpu_memory.allocated - 1
+        tick()
+        assert events[1:] == [(hidden, "released")]
+        assert gpu_memory.allocated <= gpu_memory.budget
+
+        # All the visible instances are downgraded by one level before any
+        # of them is downgraded further.
+        full = sum(gpu_memory.get_usage(glasses[1]).values())
+        saving = full - full // 4
+        del events[:]
+        gpu_memory.budget = gpu_memory.allocated - 2 * saving - 1
+        tick(2)
+        assert [fg.memory_level for fg in glasses] == ["reduced"] * 3
+
+        del events[:]
+        gpu_memory.budget = 1
+        tick(2)
+        downgraded = [event for event in events if len(event) == 2]
+        # From the one that has been visible for the longest time.
+        order = [glasses[1], glasses[2], glasses[0]]
+        assert downgraded == [
+            (fg, level)
+            for level in ("reduced", "shared_noise", "static")
+            for fg in order
+        ]
+        for fg in glasses:
+            assert fg.memory_level == "static"
+            assert tuple(fg.h_blur.size) == (1, 1)
+            assert fg.bt_1.texture is not None
+            assert fg.bt_2.texture is glasses[1].bt_2.texture
+        assert gpu_memory.get_usage_by_kind()["shared_noise"] > 0
+
+        gpu_memory.budget = 0
+        tick(3)
+        for fg in glasses:
+            assert fg.memory_level == "full"
+            assert fg.bt_1.texture is fg.v_blur.texture
+            assert tuple(fg.h_blur.size) == (200, 200)
+    finally:
+        gpu_memory.unbind_uid("on_budget_exceeded", exceeded_uid)
+        gpu_memory.unbind_uid("on_downgrade", downgrade_uid)
+        gpu_memory.budget = 0
+        for fg in glasses + [hidden]:
+            Window.remove_widget(fg)
+        Window.remove_widget(background)
+
+
+def test_image_background_uses_pre_blurred_levels(tmp_path, renders):
+    from kivy.core.image import Image as CoreImage
+    from kivy.core.window import Window
+    from kivy.graphics.texture import Texture
+    from kivy.uix.image import Image
+    from kivy.uix.widget import Widget
+    from kivy_garden.frostedglass import FrostedGlass, _image_levels_cache
+    from kivy_garden.frostedglass.memory import gpu_memory
+
+    texture = Texture.create(size=(64, 32), colorfmt="rgba")
+    texture.blit_buffer(bytes(range(256)) * 32, colorfmt="rgba")
+    filename = str(tmp_path / "background.png")
+    CoreImage(texture).save(filename)
+
+    blurs = renders(method="_render_gpu_blur")
+    image = Image(source=filename, fit_mode="fill")
+    image.size = Window.size
+    fg = FrostedGlass(size_hint=(None, None))
+    fg.size = (200, 200)
+    fg.blur_backend = "gpu"
+    fg.background = image
+    Window.add_widget(image)
+    Window.add_widget(fg)
+    try:
+        tick_until_ready(fg)
+        assert fg.uses_image_levels
+        assert tuple(fg.h_blur.size) == (1, 1)
+        levels = _image_levels_cache[(filename, (64, 32))]
+        assert [tuple(level.size) for level in levels] == [
+            (64, 32), (32, 16), (16, 8), (8, 4), (4, 2)
+        ]
+        assert fg.bt_1.texture in levels and fg.bt_3.texture in levels
+        assert gpu_memory.get_usage_by_kind()["image_levels"] > 0
+
+        # Changing the blur only selects other levels.
+        mix = fg.frosted_glass_effect["level_mix"]
+        fg.blur_size = 60
+        tick()
+        assert fg.frosted_glass_effect["level_mix"] != mix
+        assert levels.index(fg.bt_1.texture) > 0
+        assert _image_levels_cache[(filename, (64, 32))] is levels
+        assert not blurs
+
+        # The levels are no longer used once the background is removed.
+        fg.background = None
+        assert not fg.uses_image_levels
+        fg.size = (150, 150)
+        tick(3)
+
+        # With the "cover" fit mode, the Image is clipped to its bounds.
+        image.fit_mode = "cover"
+        fg.background = image
+        tick(3)
+        assert not fg.uses_image_levels
+        assert blurs
+        image.fit_mode = "fill"
+        del blurs[:]
+
+        # Children of the Image are drawn with it, so it must be blurred.
+        image.add_widget(Widget())
+        fg.background = None
+        fg.background = image
+        tick(3)
+        assert not fg.uses_image_levels
+        assert blurs
+    finally:
+        Window.remove_widget(fg)
+        Window.remove_widget(image)
+
+
+def test_initialization_spread_across_frames(monkeypatch, renders):
+    import asyncio
+    from kivy.core.window import Window
+    from kivy.uix.widget import Widget
+    from kivy_garden.frostedglass import FrostedGlass
+    from kivy_garden.frostedglass.initialization import initializer
+
+    blurs = renders(method="_render_gpu_blur")
+    # At least one step is run per frame.
+    monkeypatch.setattr(initializer, "budget", 0)
+
+    background = Widget()
+    # The properties can be passed to the constructor.
+    glasses = [
+        FrostedGlass(
+            size_hint=(None, None),
+            size=(100, 100),
+            pos=(i * 110, 0),
+            background=background,
+            blur_backend="gpu",
+        )
+        for i in range(3)
+    ]
+    ready = []
+    uid = initializer.fbind("on_all_ready", lambda *args: ready.append(1))
+    Window.add_widget(background)
+    for fg in glasses:
+        Window.add_widget(fg)
+
+    async def wait_all_ready():
+        task = asyncio.ensure_future(initializer.wait_all_ready())
+        frames = 0
+        while not task.done():
+            frames += 1
+            tick()
+            await asyncio.sleep(0)
+        return frames
+
+    try:
+        tick()
+        assert not any(fg.effect_ready for fg in glasses)
+        # Placeholder: no texture is sampled.
+        effect = glasses[0].frosted_glass_effect
+        assert glasses[0].bt_1 not in effect.children
+        assert "#define USE_PLACEHOLDER" in effect.shader.fs
+        assert initializer.pending == 3
+
+        # One step per frame: uniforms, noise, Fbos and first blur.
+        frames = asyncio.run(wait_all_ready())
+        assert frames >= 3 * 4 - 1
+        assert all(fg.effect_ready for fg in glasses)
+        assert ready == [1]
+        assert initializer.pending == 0
+        assert glasses[0].bt_1 in effect.children
+        assert "#define USE_PLACEHOLDER" not in effect.shader.fs
+
+        # Each instance is blurred once, by its initialization.
+        tick(2)
+        assert sorted(map(id, blurs)) == sorted(map(id, glasses))
+    finally:
+        initializer.unbind_uid("on_all_ready", uid)
+        for fg in glasses:
+            Window.remove_widget(fg)
+        Window.remove_widget(background)
+
+
+def test_wait_all_ready_waits_for_tree_scans(monkeypatch):
+    import asyncio
+    import kivy_garden.frostedglass as frostedglass
+    from kivy.core.window import Window
+    from kivy.uix.widget import Widget
+    from kivy_garden.frostedglass.initialization import initializer
+
+    root = parent = Widget()
+    for _ in range(5):
+        child = Widget()
+        parent.add_widget(child)
+        parent = child
+    fg = frostedglass.FrostedGlass()
+    parent.add_widget(fg)
+
+    async def wait_all_ready():
+        await initializer.wait_all_ready()
+        return fg.effect_ready
+
+    monkeypatch.setattr(frostedglass, "TREE_SCAN_BUDGET", 0)
+    Window.add_widget(root)
+    try:
+        # Not queued yet: its parents are scanned one per frame.
+        assert fg.tree_scan_pending
+        assert initializer.pending == 0
+
+        loop = asyncio.new_event_loop()
+        try:
+            task = loop.create_task(wait_all_ready())
+            for _ in range(100):
+                loop.run_until_complete(asyncio.sleep(0))
+                if task.done():
+                    break
+                tick()
+            assert task.done()
+            assert task.result()
+        finally:
+            loop.close()
+    finally:
+        Window.remove_widget(root)
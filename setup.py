@@ -46,6 +46,7 @@ setup(
         'dev': ['pytest>=3.6', 'pytest-cov', 'pytest-asyncio',
                 'sphinx_rtd_theme'],
         'ci': ['coveralls', 'pycodestyle'],
+        'cpu': ['numpy'],
     },
     package_data={},
     data_files=[],